@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# bench_template.py - time domain xml generation for a large deploy
+#   compares the compiled string templates of kvm_create against building
+#   each descriptor with ElementTree, as kvm_create used to, and checks
+#   that both produce the same domains
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+import kvm_create
+
+
+def etree_xml(base_template_file, name="BASE", count=1, mem="4096", cpu="2", placement=None,
+              output_path=None):
+    """ the ElementTree path: copy, lookups and serialization per domain """
+    base_template_path = os.path.dirname(base_template_file)
+    xmldesc = ET.parse(base_template_file).getroot()
+    domains = {}
+    for i in xrange(1, count+1):
+        new_name = "{}-{}".format(name, i)
+        dom = xmldesc.copy()
+        dom.find("./name").text = new_name
+        dom.find("./memory").text = str(mem)
+        dom.find("./currentMemory").text = str(mem)
+        dom.find("./vcpu").text = str(cpu)
+        dom.find("./devices/disk/source").attrib["file"] = os.path.join(
+            base_template_path, new_name + ".ovl")
+        if placement is not None:
+            for element in placement.elements(i):
+                for old in dom.findall(element.tag):
+                    dom.remove(old)
+                dom.append(element)
+        domains[new_name] = ET.tostring(dom)
+        if output_path is not None:
+            with open(os.path.join(output_path, new_name + ".xmlovl"), "wb") as f:
+                f.write(domains[new_name])
+    return domains
+
+
+def synthetic_cells(cells, cpus):
+    """ numa topology for placement without asking libvirt """
+    return [ { "id": c, "cpus": range(c * cpus, (c + 1) * cpus), "hugepages": 0 }
+             for c in xrange(cells) ]
+
+
+def best(fn, rounds):
+    """ fastest of rounds runs, in seconds, and the last result """
+    elapsed = []
+    for _ in xrange(rounds):
+        started = time.time()
+        result = fn()
+        elapsed.append(time.time() - started)
+    return (min(elapsed), result)
+
+
+def main(args):
+    template_file = os.path.abspath(args.template)
+    placement = None
+    if args.placement != "none":
+        cells = synthetic_cells(args.cells, args.cell_cpus)
+        placement = kvm_create.Placement(cells, args.placement, args.cpu, args.mem,
+                                         xrange(1, args.count+1))
+
+    tmp = tempfile.mkdtemp()
+    try:
+        etree, reference = best(lambda: etree_xml(
+            template_file, args.name, args.count, args.mem, args.cpu, placement), args.rounds)
+        etree_files, _ = best(lambda: etree_xml(
+            template_file, args.name, args.count, args.mem, args.cpu, placement, tmp), args.rounds)
+    finally:
+        shutil.rmtree(tmp)
+
+    started = time.time()
+    kvm_create.compile_template(template_file)
+    compiled = time.time() - started
+    rendered, domains = best(lambda: kvm_create.render_xml(
+        template_file, args.name, args.count, args.mem, args.cpu, placement=placement), args.rounds)
+
+    # compare parsed trees, attribute order and quoting may differ
+    mismatched = [ n for n in reference
+                   if ET.tostring(ET.fromstring(reference[n])) != ET.tostring(ET.fromstring(domains[n])) ]
+
+    print "{} domains, placement {}, best of {}".format(args.count, args.placement, args.rounds)
+    print "{:<24}{:>10.1f} ms".format("etree", etree * 1e3)
+    print "{:<24}{:>10.1f} ms".format("etree + .xmlovl files", etree_files * 1e3)
+    print "{:<24}{:>10.1f} ms".format("compile (once)", compiled * 1e3)
+    print "{:<24}{:>10.1f} ms  ({:.1f}x)".format("compiled render", rendered * 1e3,
+                                               etree / max(rendered, 1e-9))
+    if mismatched:
+        print "[-] {} domains differ, e.g. {}".format(len(mismatched), mismatched[0])
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("template", help="Base XMLDesc Template File")
+    parser.add_argument("-c", "--count", default=1000, type=int)
+    parser.add_argument("-n", "--name", default="BASE")
+    parser.add_argument("--mem", default="4096")
+    parser.add_argument("--cpu", default="2")
+    parser.add_argument("--placement", default="none", choices=["none", "numa", "pinned"])
+    parser.add_argument("--cells", default=2, type=int, help="synthetic numa cells for placement")
+    parser.add_argument("--cell-cpus", default=16, type=int, help="cpus per synthetic numa cell")
+    parser.add_argument("-r", "--rounds", default=5, type=int)
+    args = parser.parse_args()
+
+    sys.exit(main(args))
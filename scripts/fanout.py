@@ -0,0 +1,108 @@
+# fanout.py - bounded concurrent execution of per-host operations
+import collections
+import Queue
+import threading
+import time
+
+
+class RateLimiter(object):
+    """
+    spaces successive calls to wait() at least 1/rate seconds apart
+    """
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next)
+            self.next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class Task(object):
+    def __init__(self, host, fn, args, kwargs):
+        self.host = host
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self.duration = None
+
+    def run(self):
+        started = time.time()
+        try:
+            self.result = self.fn(*self.args, **self.kwargs)
+        except Exception as e:
+            self.error = e
+        self.duration = time.time() - started
+        return self
+
+
+class FanOut(object):
+    """
+    runs submitted tasks concurrently
+
+    workers   - global cap on tasks running at once
+    per_host  - cap on tasks running at once against a single host
+    rate      - max task starts per second against a single host
+    """
+    def __init__(self, workers=64, per_host=8, rate=None):
+        self.slots = threading.Semaphore(workers)
+        self.per_host = per_host
+        self.rate = rate
+        self.tasks = collections.OrderedDict()
+
+    def submit(self, host, fn, *args, **kwargs):
+        task = Task(host, fn, args, kwargs)
+        self.tasks.setdefault(host, []).append(task)
+        return task
+
+    def _host_worker(self, queue, limiter, done):
+        while True:
+            try:
+                task = queue.get_nowait()
+            except Queue.Empty:
+                return
+            limiter.wait()
+            with self.slots:
+                done.put(task.run())
+
+    def run(self):
+        """
+        executes all submitted tasks
+
+        yields each task in completion order once it has finished
+        """
+        tasks, self.tasks = self.tasks, collections.OrderedDict()
+        done = Queue.Queue()
+        total = 0
+        for host, host_tasks in tasks.iteritems():
+            queue = Queue.Queue()
+            for task in host_tasks:
+                queue.put(task)
+            total += len(host_tasks)
+            limiter = RateLimiter(self.rate)
+            for i in xrange(min(self.per_host, len(host_tasks))):
+                t = threading.Thread(
+                    name="{}-{}".format(host, i),
+                    target=self._host_worker,
+                    args=(queue, limiter, done)
+                )
+                t.daemon = True
+                t.start()
+
+        for _ in xrange(total):
+            # poll so the main thread stays responsive to ctrl-c
+            while True:
+                try:
+                    yield done.get(timeout=1)
+                    break
+                except Queue.Empty:
+                    pass
@@ -0,0 +1,141 @@
+# health.py - guest readiness probes
+#   each guest runs its checks in order (domain, lease, port, winrm) with a
+#   timeout per check, and results are cached briefly so dashboards polling
+#   inventory.py or webvirt do not re-probe every guest
+import collections
+import socket
+import threading
+import time
+
+HEALTH_TTL = 15
+CHECK_TIMEOUT = 5
+
+# libvirt virDomainState values
+DOMAIN_STATES = {
+    0: "nostate", 1: "running", 2: "blocked", 3: "paused",
+    4: "shutdown", 5: "shutoff", 6: "crashed", 7: "pmsuspended"
+}
+
+
+def timed(fn, timeout):
+    """
+    runs a check in a daemon thread, giving up after timeout seconds
+
+    checks return (ok, detail); raising counts as a failure
+    """
+    outcome = []
+
+    def target():
+        try:
+            outcome.append(fn())
+        except Exception as e:
+            outcome.append((False, repr(e)))
+
+    t = threading.Thread(target=target)
+    t.daemon = True
+    t.start()
+    t.join(timeout)
+    if not outcome:
+        return (False, "timed out after {}s".format(timeout))
+    return outcome[0]
+
+
+def domain_check(state):
+    return (state == 1, DOMAIN_STATES.get(state, "unknown"))
+
+
+def lease_check(ip):
+    if ip is None:
+        return (False, "no lease")
+    return (True, ip)
+
+
+def port_check(connect, port):
+    """ connect(port) returns whether the guest accepted the connection """
+    if connect(port):
+        return (True, "{} open".format(port))
+    return (False, "{} closed".format(port))
+
+
+def tcp_connect(ip, port, timeout=CHECK_TIMEOUT):
+    try:
+        socket.create_connection((ip, port), timeout).close()
+        return True
+    except socket.error:
+        return False
+
+
+def winrm_check(run_ps):
+    """ run_ps(command) returns (stdout, stderr, exit status) """
+    out, err, status = run_ps("whoami")
+    if status == 0:
+        return (True, out.strip())
+    return (False, err.strip() or "exit {}".format(status))
+
+
+def probe(checks, timeout=CHECK_TIMEOUT):
+    """
+    runs checks, a list of (check name, fn), for a single guest
+
+    checks after the first failure are skipped, they cannot pass
+
+    returns { "healthy": bool, "checked": 0.0,
+              "checks": { "<name>": { "ok", "detail", "duration" } } }
+    """
+    result = {"healthy": True, "checks": collections.OrderedDict()}
+    for name, fn in checks:
+        if not result["healthy"]:
+            result["checks"][name] = {"ok": None, "detail": "skipped", "duration": 0}
+            continue
+        started = time.time()
+        ok, detail = timed(fn, timeout)
+        result["checks"][name] = {
+            "ok": ok,
+            "detail": detail,
+            "duration": round(time.time() - started, 3)
+        }
+        result["healthy"] = ok
+    result["checked"] = time.time()
+    return result
+
+
+def describe(result):
+    """ one line summary of a probe result """
+    parts = []
+    for name, check in result["checks"].iteritems():
+        if check["ok"] is None:
+            parts.append("{} skipped".format(name))
+        else:
+            parts.append("{} {} ({})".format(name, "ok" if check["ok"] else "failed", check["detail"]))
+    return ", ".join(parts)
+
+
+class HealthCache(object):
+    """
+    probe results by guest key, reused for ttl seconds
+
+    entries is a plain dict so callers can persist it as json
+    """
+    def __init__(self, ttl=HEALTH_TTL, entries=None):
+        self.ttl = ttl
+        self.entries = entries if entries is not None else {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            result = self.entries.get(key)
+        if result is None or time.time() - result["checked"] > self.ttl:
+            return None
+        return result
+
+    def put(self, key, result):
+        with self.lock:
+            self.entries[key] = result
+
+    def probe(self, key, checks, timeout=CHECK_TIMEOUT):
+        """ cached result for key, probing the guest when it expired """
+        result = self.get(key)
+        if result is None:
+            result = probe(checks, timeout)
+            self.put(key, result)
+        return result
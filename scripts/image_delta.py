@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# image_delta.py - roll out a new golden image as a delta of the previous one
+#   the delta is a qcow2 layer holding only the clusters that changed, backed
+#   by the previous image already on each kvm host, where it is flattened
+#   back into a standalone image and checked against the delta chain
+import argparse
+import os
+import pipes
+import subprocess
+import sys
+
+import fanout
+import registry
+import sshpool
+import transfer
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+ANSIBLE_PATH = os.path.dirname(BASE_PATH)
+HOST_PATH = os.path.join(ANSIBLE_PATH, "hosts")
+
+
+def build_delta(old, new, delta, remote_backing):
+    """
+    writes a qcow2 layer to delta holding what differs between old and new
+
+    an empty overlay on new is rebased (safely) onto old, which copies in
+    only the clusters that differ, then relabelled to the path old has on
+    the kvm hosts
+    """
+    tmp = delta + ".tmp"
+    try:
+        subprocess.check_call([ "qemu-img", "create", "-q", "-f", "qcow2",
+                                "-b", os.path.abspath(new), "-F", "qcow2", tmp ])
+        subprocess.check_call([ "qemu-img", "rebase", "-f", "qcow2",
+                                "-b", os.path.abspath(old), "-F", "qcow2", tmp ])
+        subprocess.check_call([ "qemu-img", "rebase", "-u", "-f", "qcow2",
+                                "-b", remote_backing, "-F", "qcow2", tmp ])
+        os.rename(tmp, delta)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def remote_sha256(ssh, path):
+    """
+    sha256 recorded next to an image, else computed on the host
+    """
+    out, _, status = ssh.exec_command("cat {}".format(pipes.quote(path + ".sha256")))
+    if status == 0 and out.strip():
+        return out.strip()
+    return transfer.remote_digest(ssh, path)["sha256"]
+
+
+def apply_delta(ssh, delta, old_sha256, new_sha256, work_path, old_name, new_name,
+                stage_path, progress=None):
+    """
+    pushes and flattens the delta on one kvm host
+
+    returns "current" if the host already has the new image, "applied"
+    otherwise; raises if the host's previous image is not the one the
+    delta was built against
+    """
+    new_path = os.path.join(work_path, new_name)
+    old_path = os.path.join(work_path, old_name)
+    out, _, _ = ssh.exec_command("cat {}".format(pipes.quote(new_path + ".sha256")))
+    if out.strip() == new_sha256:
+        return "current"
+    if remote_sha256(ssh, old_path) != old_sha256:
+        raise IOError("{} does not match the delta base, copy the full image".format(old_path))
+
+    # the upload is verified by checksum before it is renamed into place
+    remote_delta = os.path.join(stage_path, new_name + ".delta")
+    transfer.upload(ssh, delta, remote_delta, progress)
+
+    script = (" && ".join([
+        "qemu-img convert -O qcow2 {delta} {tmp}",
+        "qemu-img compare -q -f qcow2 -F qcow2 {delta} {tmp}",
+        "mv {tmp} {new}",
+        "echo {sha256} > {new}.sha256",
+        "rm -f {delta}"
+    ]) + " || {{ rm -f {tmp}; exit 1; }}").format(
+        delta=pipes.quote(remote_delta),
+        tmp=pipes.quote(new_path + ".tmp"),
+        new=pipes.quote(new_path),
+        sha256=new_sha256
+    )
+    _, err, status = ssh.exec_command("sudo sh -c {}".format(pipes.quote(script)))
+    if status != 0:
+        raise IOError("flattening {} failed: {}".format(new_path, err.strip()))
+    return "applied"
+
+
+def kvm_hosts(hosts_path):
+    # ansible is slow to import and only needed without explicit hosts
+    from ansible.parsing.dataloader import DataLoader
+    from ansible.vars import VariableManager
+    from ansible.inventory import Inventory
+
+    ldr, vmr = DataLoader(), VariableManager()
+    inv = Inventory(loader=ldr, variable_manager=vmr, host_list=hosts_path)
+    return [str(host) for host in inv.get_hosts("kvm")]
+
+
+def main(args):
+    old_name = args.old_name or os.path.basename(args.old)
+    new_name = args.name or os.path.basename(args.new)
+    hosts = args.vhost or kvm_hosts(args.hosts_path)
+
+    # registered images are not hashed again
+    reg = registry.Registry(args.registry)
+    old_sha256 = reg.sha256(args.old, record=True)
+    new_sha256 = reg.sha256(args.new, record=True)
+
+    delta_path = args.new + ".delta"
+    print "[*] Building delta {}".format(delta_path)
+    build_delta(args.old, args.new, delta_path, os.path.join(args.work_path, old_name))
+    delta = transfer.LocalFile(delta_path)
+    print "delta: {:.1f} MB of {:.1f} MB".format(delta.size / 1e6, os.path.getsize(args.new) / 1e6)
+
+    pool = sshpool.SSHPool()
+    progress = transfer.Progress().start()
+    fan = fanout.FanOut(workers=args.workers, per_host=1)
+    for host in hosts:
+        fan.submit(host, apply_delta, pool.get(host, args.user), delta, old_sha256, new_sha256,
+                   args.work_path, old_name, new_name, args.stage_path, progress)
+
+    failed = 0
+    for task in fan.run():
+        if task.error is not None:
+            failed += 1
+            print "[-] {} - {}".format(task.host, repr(task.error))
+        else:
+            reg.mark(new_sha256, task.host)
+            print "{} - {} [{:.1f}s]".format(task.host, task.result, task.duration)
+    progress.stop()
+    pool.close()
+
+    if not args.keep:
+        os.remove(delta_path)
+    print "sent {:.1f} MB to {} hosts, {} failed".format(progress.sent / 1e6, len(hosts), failed)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("old", help="previous image, as deployed on the kvm hosts")
+    parser.add_argument("new", help="new image")
+    parser.add_argument("vhost", nargs="*", help="kvm hosts (default the kvm group)")
+    parser.add_argument("-u", "--user", default="srt")
+    parser.add_argument("-H", "--hosts_path", default=HOST_PATH)
+    parser.add_argument("-r", "--registry", default=registry.REGISTRY_PATH)
+    parser.add_argument("--old-name", help="previous image name on the kvm hosts (default old's name)")
+    parser.add_argument("--name", help="new image name on the kvm hosts (default new's name)")
+    parser.add_argument("-wp", "--work-path", default="/haka", help="kvm work path holding the images")
+    parser.add_argument("-sp", "--stage-path", default="/haka/tmp", help="kvm path the delta is uploaded to")
+    parser.add_argument("-w", "--workers", default=16, type=int, help="kvm hosts updated at once")
+    parser.add_argument("--keep", action="store_true", help="keep the local delta file")
+    args = parser.parse_args()
+
+    sys.exit(main(args))
@@ -2,39 +2,83 @@
 # inventory.py - assist in monitoring windows-based kvm domains
 import argparse
 import collections
+import io
+import ntpath
 import os
+import pipes
 import re
 import Queue
 import subprocess
+import sys
 import threading
 import time
 import xml.etree.ElementTree as ET
 import yaml
 
-from ansible.parsing.dataloader import DataLoader
-from ansible.vars import VariableManager
-from ansible.inventory import Inventory
 import libvirt
 import paramiko
 
+import fanout
+import health
+import inventory_cache
+import results
+import sshpool
+import transfer
+import winrmpool
+
 paramiko.util.log_to_file(os.devnull)
 
 BASE_PATH = os.path.dirname(os.path.abspath(__file__))
 ANSIBLE_PATH = os.path.dirname(BASE_PATH)
 HOST_PATH = os.path.join(ANSIBLE_PATH, "hosts")
 CRED_PATH = os.path.join(ANSIBLE_PATH, "group_vars", "all.yml")
+CACHE_PATH = os.path.join(ANSIBLE_PATH, ".inventory_cache.json")
+
+# commands answered from the inventory cache, refreshing in the background
+LOOKUP_COMMANDS = ("list", "view")
+
+# libvirt domain lifecycle actions, "hard-reset" is a power cycle
+LIFECYCLE_ACTIONS = collections.OrderedDict([
+    ("reboot", lambda dom: dom.reboot()),
+    ("hard-reset", lambda dom: dom.reset()),
+    ("shutdown", lambda dom: dom.shutdown()),
+    ("start", lambda dom: dom.create()),
+    ("suspend", lambda dom: dom.suspend()),
+    ("resume", lambda dom: dom.resume()),
+    ("destroy", lambda dom: dom.destroy())
+])
+STOP_ACTIONS = ("shutdown", "destroy")
 
 G = lambda s: "\033[92m{}\033[0m".format(s)
 R = lambda s: "\033[91m{}\033[0m".format(s)
 
 class KVMHost(object):
-    def __init__(self, user, host, network="default"):
+    def __init__(self, user, host, network="default", pool=None, sessions=None):
         self.hostname = host
         self.username = user
         self.conn_cmd = "qemu+ssh://{}@{}/system".format(user, host)
-        self.conn = libvirt.open(self.conn_cmd)
+        self._conn = None
+        self.lock = threading.Lock()
         self.network = network
         self.nodes = []
+        self.macs = {}
+        self.lease_lock = threading.Lock()
+        self.lease_cache = {}
+        self.lease_time = 0
+        if pool is None:
+            pool = sshpool.SSHPool()
+        self.ssh = pool.get(host, user)
+        if sessions is None:
+            sessions = winrmpool.WinRMPool()
+        self.winrm = sessions
+
+    @property
+    def conn(self):
+        # opened on first use, cached inventory lookups never connect
+        with self.lock:
+            if self._conn is None:
+                self._conn = libvirt.open(self.conn_cmd)
+            return self._conn
 
     def get_net_hosts(self):
         """
@@ -52,20 +96,54 @@ class KVMHost(object):
 
     def get_mac_domain(self):
         """
-        reads all kvm domain xml descriptors for lookup of mac to domain
+        resolves the mac of each running domain for lookup of mac to domain
+
+        macs are cached by domain uuid and id: a new domain has a new
+        uuid, and a redefined interface only takes effect on a restart,
+        which assigns a new id
 
         returns a dict of mac address keys to domain name values
         """
-        domains = self.conn.listAllDomains()
+        domains = self.conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
 
         mac_to_dom = {}
+        macs = {}
         for domain in domains:
-            xml = ET.fromstring(domain.XMLDesc())
-            mac = xml.find("./devices/interface/mac").attrib["address"]
-
+            key = "{}:{}".format(domain.UUIDString(), domain.ID())
+            mac = self.macs.get(key)
+            if mac is None:
+                mac = self._resolve_mac(domain)
+            if mac is None:
+                continue
+            macs[key] = mac
             mac_to_dom[mac] = domain.name()
+        # forget domains that went away
+        self.macs = macs
         return mac_to_dom
 
+    def _resolve_mac(self, domain):
+        """
+        returns the first interface mac of a domain, asking for its lease
+        before falling back to the domain xml
+        """
+        try:
+            ifaces = domain.interfaceAddresses(libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE)
+            for iface in ifaces.itervalues():
+                if iface["hwaddr"]:
+                    return iface["hwaddr"]
+        except (libvirt.libvirtError, AttributeError):
+            # no lease yet, or libvirt older than 1.2.14
+            pass
+
+        # stop parsing at the first interface mac
+        in_interface = False
+        for _, elem in ET.iterparse(io.BytesIO(domain.XMLDesc()), events=("start",)):
+            if elem.tag == "interface":
+                in_interface = True
+            elif elem.tag == "mac" and in_interface:
+                return elem.attrib["address"]
+        return None
+
     def inventory(self):
         """
         returns a list of dicts describing domain network info
@@ -86,45 +164,57 @@ class KVMHost(object):
         self.nodes = sorted(node_inventory, key=lambda d: d["name"])
         return self.nodes
 
+    def upload_file(self, local_path, kvm_path, local=None, progress=None,
+                    store_size=transfer.STORE_SIZE, keep=()):
+        """
+        stages a local file in the content addressed store under kvm_path
+
+        uploads are chunked and resumable, and skipped when the content
+        is already staged; keep lists digests eviction must spare
+
+        returns a tuple of (path under the web root, whether anything was sent)
+        """
+        if local is None:
+            local = transfer.LocalFile(local_path)
+        store = transfer.Store(self.ssh, os.path.join(kvm_path, "cas"), store_size)
+        sent = store.put(local, progress=progress, keep=keep)
+        return (store.url_path(local), sent)
+
+    def send_script(self, files, web_srv="192.168.122.1", execute=None):
+        """
+        single powershell script for a node to fetch, checksum and
+        optionally execute staged files
+
+        files is a list of (path under the web root, win path, sha256);
+        execute runs the first file with the given switches
+        """
+        script = [
+            '$wc = new-object system.net.webclient',
+            '$sha = [security.cryptography.sha256]::create()',
+            'function fetch($u, $p, $d) {'
+            ' $wc.downloadfile($u, $p);'
+            ' $f = [io.file]::openread($p);'
+            ' $h = [bitconverter]::tostring($sha.computehash($f)).replace("-", "").tolower();'
+            ' $f.close();'
+            ' if ($h -ne $d) { write-error "checksum mismatch: $p"; exit 1 };'
+            ' write-host "downloaded $p" }'
+        ]
+        for url_path, win_path, digest in files:
+            script.append('fetch "http://{}/{}" "{}" "{}"'.format(web_srv, url_path, win_path, digest))
+        if execute is not None:
+            script.append('& "{}" {}'.format(files[0][1], execute))
+        return "\n".join(script)
+
     def send_file(self, local_path, win_path, kvm_path, node_user=None, node_pass=None,
                   web_srv="192.168.122.1", node_name=None, execute=None):
 
         node_user, node_pass = self._node_creds(node_user, node_pass)
 
-        fname = os.path.basename(local_path)
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(self.hostname, username=self.username)
-
-        # add filename to kvm_path
-        if not kvm_path.endswith(fname):
-            kvm_path = os.path.join(kvm_path, fname)
-
-        # drop file into path
-        sftp = ssh.open_sftp()
-        sftp.chdir(os.path.dirname(kvm_path))
-        try:
-            sftp.put(local_path, kvm_path)
-        except IOError as e:
-            print repr(e)
-            print "Failed to send file to %s with path %s, attempting to delete as root before trying again" % (self.hostname, kvm_path)
-            _, stdout, stderr = ssh.exec_command("sudo rm -f {}".format(kvm_path))
-            err = stderr.read()
-            out = stdout.read()
-            if err:
-                print err
-            if out:
-                print out
-            try:
-                sftp.put(local_path, kvm_path)
-            except Exception as e:
-                print repr(e)
-                print "Failed to send file to %s with path %s again, aborting" % (self.hostname, kvm_path)
-                raise
+        local = transfer.LocalFile(local_path)
+        url_path, _ = self.upload_file(local_path, kvm_path, local=local)
 
-        # download files
-        cmd = '(new-object system.net.webclient).downloadfile("http://{}/{}","{}"); write-host -nonewline downloaded'
-        cmd = cmd.format(web_srv, fname, win_path)
+        # download (and execute) files
+        cmd = self.send_script([(url_path, win_path, local.sha256)], web_srv, execute)
 
         self.command_nodes(
             node_name=node_name,
@@ -133,15 +223,6 @@ class KVMHost(object):
             command=cmd
         )
 
-        if execute is not None:
-            cmd = "{} {}".format(win_path, execute)
-            self.command_nodes(
-                node_name=node_name,
-                node_user=node_user,
-                node_pass=node_pass,
-                command=cmd
-            )
-
     def view(self, node_names=None, delay=1):
         """
         run virt-viewer on target nodes
@@ -169,22 +250,16 @@ class KVMHost(object):
 
     def command_host(self, command):
         """
-        execute shell command on kvm host via ssh
-        """
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        execute shell command on kvm host via the pooled ssh connection
 
-        try:
-            ssh.connect(self.hostname, username=self.username)
-            _, stdout, stderr = ssh.exec_command(command)
-            err = stderr.read()
-            out = stdout.read()
-            if err:
-                print err
-            if out:
-                print out
-        finally:
-            ssh.close()
+        returns a tuple of (stdout, stderr, exit status)
+        """
+        out, err, status = self.ssh.exec_command(command)
+        if err:
+            print err
+        if out:
+            print out
+        return (out, err, status)
 
     def _node_creds(self, node_user, node_pass):
         # default node creds
@@ -197,172 +272,456 @@ class KVMHost(object):
         return (node_user, node_pass)
 
 
-    def command_nodes(self, command, node_user=None, node_pass=None, node_name=None):
+    def select_nodes(self, node_name=None):
         """
-        execute powershell command on selected nodes via winrm
+        returns the inventory entries matching a node selection
+
+        None selects all nodes, a list selects by domain name, and a
+        single value selects by ip address
         """
-        # select all nodes
         if node_name == None:
-            node_name = [n["name"] for n in self.nodes if n]
+            return [n for n in self.nodes if n]
+        if isinstance(node_name, list):
+            return [n for n in self.nodes if n["name"] in node_name]
+        return [n for n in self.nodes if n["ip"] == node_name]
+
+    def command_node(self, node, command, node_user, node_pass):
+        """
+        execute powershell command on a single node via winrm
+
+        returns a tuple of (stdout, stderr, exit status)
+        """
+        return self.winrm.run_ps(self.ssh, node["ip"], node_user, node_pass, command)
+
+    def command_node_sequence(self, node, commands, node_user, node_pass):
+        """
+        execute powershell commands in order on a single node
 
+        returns a list of (command, stdout, stderr, exit status)
+        """
+        outputs = []
+        for command in commands:
+            out, err, status = self.command_node(node, command, node_user, node_pass)
+            outputs.append((command, out, err, status))
+        return outputs
+
+    def command_nodes(self, command, node_user=None, node_pass=None, node_name=None):
+        """
+        execute powershell command on selected nodes via winrm
+        """
         node_user, node_pass = self._node_creds(node_user, node_pass)
 
-        if isinstance(node_name, list):
-            nodes = [n for n in self.nodes if n["name"] in node_name]
-            for node in nodes:
-                print "{} - {} - {}".format(self.hostname, node["name"], command)
-                cmd = self._winrm(
-                    hostname=node["ip"],
-                    username=node_user,
-                    password=node_pass,
-                    command=command
-                )
-                self.command_host(cmd)
-        else:
-            nodes = [n for n in self.nodes if n["ip"] == node_name]
-            for node in nodes:
-                print "{} - {} - {}".format(self.hostname, node["name"], command)
-                cmd = self._winrm(
-                    hostname=node["ip"],
-                    username=node_user,
-                    password=node_pass,
-                    command=command
-                )
-                self.command_host(cmd)
-
-    def _winrm(self, hostname, username, password, command):
-        """
-        wrap commands for python + pywinrm execution
-        """
-        wrm = []
-        wrm.append("import winrm")
-        w = 'res = winrm.Session("{}",auth=("{}","{}")).run_ps("""{}""")'
-        w = w.format(hostname, username, password, command)
-        wrm.append(w)
-        wrm.append('print "out: {}".format(res.std_out)')
-        wrm.append('print "err: {}".format(res.std_err)')
-        wrm = ";".join(wrm).strip()
-        cmd = """python -c '{}'""".format(wrm)
-        return cmd
+        for node in self.select_nodes(node_name):
+            print "{} - {} - {}".format(self.hostname, node["name"], command)
+            out, err, _ = self.command_node(node, command, node_user, node_pass)
+            if err:
+                print err
+            if out:
+                print out
+
+    def domains(self, node_names=None):
+        """
+        resolves domains with a single listAllDomains call
+
+        returns an ordered dict of domain name to virDomain; None selects
+        every domain, unknown names are left out
+        """
+        domains = collections.OrderedDict(
+            sorted(((dom.name(), dom) for dom in self.conn.listAllDomains()), key=lambda d: d[0]))
+        if node_names is None:
+            return domains
+        return collections.OrderedDict((n, domains[n]) for n in node_names if n in domains)
+
+    def leases(self, max_age=1):
+        """
+        returns a dict of mac to (ip, lease expiry time)
+
+        concurrent waiters share one DHCPLeases call per max_age seconds
+        """
+        with self.lease_lock:
+            if time.time() - self.lease_time > max_age:
+                net = self.conn.networkLookupByName(self.network)
+                self.lease_cache = dict(
+                    (e["mac"], (e["ipaddr"], e["expirytime"])) for e in net.DHCPLeases())
+                self.lease_time = time.time()
+            return self.lease_cache
+
+    def _domain_mac(self, dom):
+        name = dom.name()
+        for node in self.nodes:
+            if node["name"] == name:
+                return node["mac"]
+        return self._resolve_mac(dom)
+
+    def _winrm_ready(self, ip, node_user, node_pass):
+        try:
+            _, _, status = self.winrm.run_ps(self.ssh, ip, node_user, node_pass, "hostname")
+        except winrmpool.WINRM_ERRORS + sshpool.SSH_ERRORS:
+            return False
+        return status == 0
+
+    def lifecycle_node(self, dom, action, wait=None, timeout=600,
+                       node_user=None, node_pass=None, interval=2):
+        """
+        runs a lifecycle action on a domain, optionally waiting until it
+        is ready again
+
+        shutdown and destroy wait for the domain to stop, other actions
+        wait for a renewed dhcp lease ("lease") and then for winrm to
+        answer ("winrm")
+
+        returns the node ip, if known
+        """
+        mac, before = None, None
+        if wait and action not in STOP_ACTIONS:
+            mac = self._domain_mac(dom)
+            before = self.leases().get(mac, (None, None))[1]
+
+        LIFECYCLE_ACTIONS[action](dom)
+        if not wait or action == "suspend":
+            return None
+
+        deadline = time.time() + timeout
+        while True:
+            ip = None
+            if action in STOP_ACTIONS:
+                ready = not dom.isActive()
+            else:
+                ip, expiry = self.leases().get(mac, (None, None))
+                # a resumed guest keeps its lease, booted guests renew it
+                ready = expiry is not None and (action == "resume" or expiry != before)
+                if ready and wait == "winrm":
+                    ready = self._winrm_ready(ip, node_user, node_pass)
+            if ready:
+                return ip
+            if time.time() > deadline:
+                raise RuntimeError("not ready after {}s".format(timeout))
+            time.sleep(interval)
 
     def reboot_nodes(self, node_names=None, delay=1):
         """
         graceful reboot of selected nodes with delay
         """
-        # reboot all nodes
-        if node_names == None:
-            for dom in self.conn.listAllDomains():
-                try:
-                    dom.reboot()
-                    print "Reboot: {} - {}".format(self.hostname, dom.name())
-                except libvirt.libvirtError as e:
-                    print "[-] Failed to reboot {}. {}".format(dom.name(), repr(e))
-                time.sleep(delay)
-            return
+        if node_names is not None and not isinstance(node_names, list):
+            node_names = [node_names]
 
-        if isinstance(node_names, list):
-            for node_name in node_names:
-                try:
-                    dom = self.conn.lookupByName(node_name)
-                    dom.reboot()
-                    print "Reboot: {} - {}".format(self.hostname, dom.name())
-                except libvirt.libvirtError as e:
-                    print "[-] Failed to reboot {}. {}".format(node_name, repr(e))
-                time.sleep(delay)
-        else:
+        for node_name, dom in self.domains(node_names).iteritems():
             try:
-                dom = self.conn.lookupByName(node_names)
-                dom.reboot()
+                self.lifecycle_node(dom, "reboot")
+                print "Reboot: {} - {}".format(self.hostname, node_name)
             except libvirt.libvirtError as e:
-                print "[-] Failed to reboot {}. {}".format(node_names, repr(e))
+                print "[-] Failed to reboot {}. {}".format(node_name, repr(e))
+            time.sleep(delay)
+
+    def domain_states(self):
+        """
+        returns a dict of domain name to libvirt state from a single
+        getAllDomainStats call
+        """
+        stats = self.conn.getAllDomainStats(libvirt.VIR_DOMAIN_STATS_STATE)
+        return dict((dom.name(), stat["state.state"]) for dom, stat in stats)
+
+    def health_node(self, node, states, cache, port=winrmpool.WINRM_PORT,
+                    timeout=health.CHECK_TIMEOUT, node_user=None, node_pass=None):
+        """
+        probes domain state, dhcp lease, winrm port and winrm login of a
+        node, reusing a fresh cached result
+
+        the port is reached through the kvm host ssh connection, and the
+        winrm check is skipped without node credentials
+        """
+        name = node["name"]
+        # later checks use the live lease address, the cached one may be stale
+        live = {"ip": node["ip"]}
+
+        def lease():
+            live["ip"] = self.leases().get(node["mac"], (None, None))[0]
+            return health.lease_check(live["ip"])
+
+        def run_ps(command):
+            return self.winrm.run_ps(self.ssh, live["ip"], node_user, node_pass, command)
+
+        checks = [
+            ("domain", lambda: health.domain_check(states.get(name))),
+            ("lease", lease),
+            ("port", lambda: health.port_check(lambda p: self.ssh.reachable(live["ip"], p), port))
+        ]
+        if node_user is not None:
+            checks.append(("winrm", lambda: health.winrm_check(run_ps)))
+        return cache.probe("{}/{}".format(self.hostname, name), checks, timeout)
+
+
+def select_hosts(inventory, vhosts, vnode=None):
+    """
+    yields (kvm host, node selection) pairs for the vhost arguments
+    """
+    for vhost in vhosts:
+        if vhost.lower() == "all":
+            for name, kvm in inventory.iteritems():
+                yield kvm, None
+        else:
+            yield inventory[vhost], vnode
 
 
 def ansible_inventory(hosts_path):
+    # ansible is slow to import and only needed when the hosts file changed
+    from ansible.parsing.dataloader import DataLoader
+    from ansible.vars import VariableManager
+    from ansible.inventory import Inventory
+
     ldr, vmr = DataLoader(), VariableManager()
     return Inventory(loader=ldr, variable_manager=vmr, host_list=hosts_path)
 
 
-def main(args):
-    # use ansible hosts file to get full kvm host + domain inventory
-    inv = ansible_inventory(args.hosts_path)
+def kvm_hosts(cache, hosts_path):
+    """
+    returns the kvm group of the ansible hosts file, cached until it changes
+    """
+    hosts = cache.kvm_hosts(hosts_path)
+    if hosts is None:
+        inv = ansible_inventory(hosts_path)
+        hosts = [str(host) for host in inv.get_hosts("kvm")]
+        cache.set_kvm_hosts(hosts_path, hosts)
+    return hosts
 
-    results = Queue.Queue()
 
-    def worker(user, host):
+def refresh_inventory(kvms, cache):
+    """
+    retrieves domain inventory from each kvm host concurrently
+
+    returns the kvm hosts that responded, cache entries are updated
+    """
+    responded = Queue.Queue()
+
+    def worker(kvm):
         try:
-            kvm = KVMHost(user, host)
             kvm.inventory()
-            results.put(kvm)
+            responded.put(kvm)
         except libvirt.libvirtError:
             pass
 
-    # retrieve inventory of all kvm host and domains
     threads = []
-    for host in inv.get_hosts("kvm"):
-        host = str(host)
-        t = threading.Thread(name=host, target=worker, args=(args.user, host))
+    for kvm in kvms:
+        t = threading.Thread(name=kvm.hostname, target=worker, args=(kvm,))
         t.start()
         threads.append(t)
     [t.join(60) for t in threads]
 
+    refreshed = []
+    while not responded.empty():
+        kvm = responded.get()
+        cache.put(kvm.hostname, kvm.nodes, kvm.macs)
+        refreshed.append(kvm)
+    return refreshed
+
+
+def refresh_in_background(args, hosts):
+    """
+    spawns a detached `refresh` of stale hosts so lookups return at once
+    """
+    lock = args.cache_path + ".lock"
+    try:
+        # skip if another refresh started recently
+        if time.time() - os.path.getmtime(lock) < 60:
+            return
+    except OSError:
+        pass
+    open(lock, "wb").close()
+
+    cmd = [
+        sys.executable, os.path.abspath(__file__),
+        "-u", args.user,
+        "-H", args.hosts_path,
+        "--cache-path", args.cache_path,
+        "refresh"
+    ] + hosts
+    with open(os.devnull, "wb") as nil:
+        subprocess.Popen(cmd, stdout=nil, stderr=nil, close_fds=True, preexec_fn=os.setsid)
+
+
+def main(args):
+    # use ansible hosts file to get full kvm host + domain inventory
+    cache = inventory_cache.InventoryCache(args.cache_path, ttl=args.ttl)
+    hosts = kvm_hosts(cache, args.hosts_path)
+
+    pool = sshpool.SSHPool(
+        channels=args.ssh_channels,
+        keepalive=args.ssh_keepalive,
+        idle_timeout=args.ssh_idle
+    )
+    sessions = winrmpool.WinRMPool(port=args.winrm_port)
+    kvms = dict((host, KVMHost(args.user, host, pool=pool, sessions=sessions)) for host in hosts)
+    for host, kvm in kvms.iteritems():
+        # resolved macs outlive the inventory ttl
+        entry = cache.get(host)
+        if entry is not None:
+            kvm.macs = entry.get("macs", {})
+
+    if args.cli == "refresh":
+        targets = args.vhost or hosts
+        refresh = [kvms[host] for host in targets if host in kvms]
+    elif args.refresh:
+        refresh = kvms.values()
+    elif args.cli in LOOKUP_COMMANDS:
+        # answer from the cache, only block on hosts never seen before
+        refresh = [kvm for host, kvm in kvms.iteritems() if cache.get(host) is None]
+        stale = [host for host in hosts if cache.get(host) is not None and cache.stale(host)]
+        if stale:
+            refresh_in_background(args, stale)
+    else:
+        refresh = [kvm for host, kvm in kvms.iteritems() if cache.stale(host)]
+
     inventory = {}
-    while not results.empty():
-        kvm = results.get()
-        inventory[kvm.hostname] = kvm
+    if refresh:
+        for kvm in refresh_inventory(refresh, cache):
+            inventory[kvm.hostname] = kvm
+    cache.save()
+
+    if args.cli == "refresh":
+        if os.path.exists(args.cache_path + ".lock"):
+            os.remove(args.cache_path + ".lock")
+        pool.close()
+        return
+
+    for host, kvm in kvms.iteritems():
+        entry = cache.get(host)
+        if host not in inventory and entry is not None:
+            # unreachable just now, only lookups may use the old entry
+            if kvm in refresh and args.cli not in LOOKUP_COMMANDS:
+                continue
+            kvm.nodes = entry["nodes"]
+            inventory[host] = kvm
     # sort by vhost
     inventory = collections.OrderedDict(sorted(inventory.iteritems(), key=lambda x: x[0]))
 
-    if args.cli == "reboot":
-        for vhost in args.vhost:
-            if vhost.lower() == "all":
-                for name, kvm in inventory.iteritems():
-                    kvm.reboot_nodes(delay=args.delay)
-            else:
-                kvm = inventory[vhost]
-                kvm.reboot_nodes(args.vnode, delay=args.delay)
+    if args.cli in LIFECYCLE_ACTIONS:
+        # stagger actions per kvm host, all hosts proceed at once
+        rate = args.rate
+        if args.delay:
+            rate = 1.0 / args.delay
+        fan = fanout.FanOut(workers=args.workers, per_host=args.per_host, rate=rate)
+        for kvm, vnode in select_hosts(inventory, args.vhost, args.vnode):
+            node_user, node_pass = args.guest_user, args.guest_pass
+            if args.wait == "winrm":
+                node_user, node_pass = kvm._node_creds(node_user, node_pass)
+            try:
+                domains = kvm.domains(vnode)
+            except libvirt.libvirtError as e:
+                # served from the cache but unreachable now, skip the host
+                sys.stderr.write("[-] {} - {}\n".format(kvm.hostname, repr(e)))
+                continue
+            for node_name in set(vnode or []) - set(domains):
+                sys.stderr.write("[-] {} - {} - no such domain\n".format(kvm.hostname, node_name))
+            for dom in domains.itervalues():
+                fan.submit(kvm.hostname, kvm.lifecycle_node, dom, args.cli,
+                           args.wait, args.timeout, node_user, node_pass)
+
+        label = args.cli if not args.wait else "{} (wait {})".format(args.cli, args.wait)
+        results.report(fan.run(), label=label, as_json=args.json, record=results.lifecycle_record)
     elif args.cli == "send":
-        for vhost in args.vhost:
-            if vhost.lower() == "all":
-                for name, kvm in inventory.iteritems():
-                    kvm.send_file(
-                        node_name=None,
-                        node_user=args.guest_user,
-                        node_pass=args.guest_pass,
-                        local_path=args.local_path,
-                        win_path=args.win_path,
-                        kvm_path=args.kvm_path,
-                        web_srv=args.web_server,
-                        execute=args.execute
-                    )
+        targets = list(select_hosts(inventory, args.vhost, args.vnode))
+        payloads = [transfer.LocalFile(path) for path in args.local_path]
+
+        # several files land in the win path as a directory
+        if len(payloads) > 1:
+            win_paths = [ntpath.join(args.win_path, os.path.basename(l.path)) for l in payloads]
+        else:
+            win_paths = [args.win_path]
+
+        # stage the files on every kvm host before any node fetches them
+        log = sys.stderr if args.json else sys.stdout
+        progress = transfer.Progress().start()
+        fan = fanout.FanOut(workers=args.workers, per_host=1)
+        # files of the batch must not evict each other
+        batch = [local.sha256 for local in payloads]
+        for kvm, _ in targets:
+            for local in payloads:
+                fan.submit(kvm.hostname, kvm.upload_file, local.path, args.kvm_path,
+                           local=local, progress=progress, store_size=int(args.store_size * (1 << 30)),
+                           keep=batch)
+        staged = collections.defaultdict(dict)
+        failed = set()
+        skipped = 0
+        for task in fan.run():
+            if task.error is not None:
+                print >>log, "[-] Failed to send {} to {}. {}".format(task.args[0], task.host, repr(task.error))
+                failed.add(task.host)
             else:
-                kvm = inventory[vhost]
-                kvm.send_file(
-                    node_name=args.vnode,
-                    node_user=args.guest_user,
-                    node_pass=args.guest_pass,
-                    local_path=args.local_path,
-                    win_path=args.win_path,
-                    kvm_path=args.kvm_path,
-                    web_srv=args.web_server,
-                    execute=args.execute
-                )
+                url_path, sent = task.result
+                staged[task.host][task.args[0]] = url_path
+                skipped += not sent
+        progress.stop()
+        print >>log, "Staged {} files on {} hosts ({} already current): {:.1f} MB at {:.1f} MB/s".format(
+            len(payloads), len(set(staged) - failed), skipped, progress.sent / 1e6, progress.rate() / 1e6)
+
+        # one round trip per node downloads, verifies and executes everything
+        fan = fanout.FanOut(workers=args.workers, per_host=args.per_host)
+        for kvm, vnode in targets:
+            if kvm.hostname in failed:
+                continue
+            files = [(staged[kvm.hostname][local.path], win_path, local.sha256)
+                     for local, win_path in zip(payloads, win_paths)]
+            script = kvm.send_script(files, args.web_server, args.execute)
+            node_user, node_pass = kvm._node_creds(args.guest_user, args.guest_pass)
+            for node in kvm.select_nodes(vnode):
+                fan.submit(kvm.hostname, kvm.command_node_sequence, node, [script], node_user, node_pass)
+        results.report(fan.run(), label="send {}".format(" ".join(win_paths)), as_json=args.json)
+    elif args.cli == "reset":
+        # kvm_create.py resets a host's nodes in parallel, one call per host
+        fan = fanout.FanOut(workers=args.workers, per_host=1)
+        for kvm, vnode in select_hosts(inventory, args.vhost, args.vnode):
+            if vnode is None:
+                try:
+                    vnode = kvm.domains().keys()
+                except libvirt.libvirtError as e:
+                    print "[-] Failed to reset nodes on {}. {}".format(kvm.hostname, repr(e))
+                    continue
+            cmd = "cd {} && sudo python kvm_create.py {} --reset {}".format(
+                pipes.quote(args.work_path),
+                pipes.quote(args.base_image),
+                " ".join(pipes.quote(name) for name in vnode)
+            )
+            fan.submit(kvm.hostname, kvm.ssh.exec_command, cmd)
+
+        for task in fan.run():
+            if task.error is not None:
+                print "[-] Failed to reset nodes on {}. {}".format(task.host, repr(task.error))
+                continue
+            out, err, _ = task.result
+            print "{}".format(R(task.host))
+            if err:
+                print err
+            if out:
+                print out
     elif args.cli == "command":
-        for vhost in args.vhost:
-            if vhost.lower() == "all":
-                for name, kvm in inventory.iteritems():
-                    kvm.command_nodes(
-                        node_user=args.guest_user,
-                        node_pass=args.guest_pass,
-                        command=args.pshell
-                    )
-            else:
-                kvm = inventory[vhost]
-                kvm.command_nodes(
-                    node_name=args.vnode,
-                    node_user=args.guest_user,
-                    node_pass=args.guest_pass,
-                    command=args.pshell
-                )
+        fan = fanout.FanOut(workers=args.workers, per_host=args.per_host)
+        for kvm, vnode in select_hosts(inventory, args.vhost, args.vnode):
+            node_user, node_pass = kvm._node_creds(args.guest_user, args.guest_pass)
+            for node in kvm.select_nodes(vnode):
+                fan.submit(kvm.hostname, kvm.command_node_sequence, node, [args.pshell], node_user, node_pass)
+        results.report(fan.run(), as_json=args.json)
+    elif args.cli == "health":
+        checker = health.HealthCache(ttl=args.health_ttl, entries=cache.data["health"])
+        fan = fanout.FanOut(workers=args.workers, per_host=args.per_host)
+        for kvm, vnode in select_hosts(inventory, args.vhost, args.vnode):
+            node_user, node_pass = None, None
+            if not args.no_winrm:
+                node_user, node_pass = kvm._node_creds(args.guest_user, args.guest_pass)
+            try:
+                states = kvm.domain_states()
+            except libvirt.libvirtError as e:
+                sys.stderr.write("[-] {} - {}\n".format(kvm.hostname, repr(e)))
+                continue
+            nodes = dict((n["name"], n) for n in kvm.nodes)
+            for name in sorted(states):
+                if vnode is not None and name not in vnode:
+                    continue
+                # domains without a lease are probed too, and fail it
+                node = nodes.get(name, {"name": name, "ip": None, "mac": None})
+                fan.submit(kvm.hostname, kvm.health_node, node, states, checker,
+                           args.port, args.timeout, node_user, node_pass)
+        results.report(fan.run(), as_json=args.json, record=results.health_record)
+        cache.save()
     elif args.cli == "view":
         for host, kvm in inventory.iteritems():
             for node in kvm.nodes:
@@ -395,11 +754,22 @@ def main(args):
     else:
         pass
 
+    pool.close()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-u", "--user", default="srt")
     parser.add_argument("-H", "--hosts_path", default=HOST_PATH)
+    parser.add_argument("--cache-path", default=CACHE_PATH, help="inventory cache file")
+    parser.add_argument("--ttl", default=inventory_cache.CACHE_TTL, type=int, help="seconds before cached host inventory is stale")
+    parser.add_argument("--refresh", action="store_true", help="refresh the inventory of every kvm host first")
+    parser.add_argument("-w", "--workers", default=64, type=int, help="max concurrent operations overall")
+    parser.add_argument("--per-host", default=8, type=int, help="max concurrent operations per kvm host")
+    parser.add_argument("--winrm-port", default=winrmpool.WINRM_PORT, type=int, help="node winrm port, https unless 5985")
+    parser.add_argument("--ssh-channels", default=8, type=int, help="concurrent ssh channels per kvm host")
+    parser.add_argument("--ssh-keepalive", default=30, type=int, help="ssh keepalive interval in seconds")
+    parser.add_argument("--ssh-idle", default=300, type=int, help="close ssh connections idle for this many seconds")
     subparsers = parser.add_subparsers(dest="cli")
 
     send_subparser = subparsers.add_parser(
@@ -408,21 +778,39 @@ if __name__ == "__main__":
     )
     send_subparser.add_argument("vhost", nargs="+")
     send_subparser.add_argument("-n", "--vnode", nargs="+")
-    send_subparser.add_argument("-lp", "--local-path", help="local path", required=True)
-    send_subparser.add_argument("-wp", "--win-path", help="win path", required=True)
+    send_subparser.add_argument("-lp", "--local-path", nargs="+", help="local path(s)", required=True)
+    send_subparser.add_argument("-wp", "--win-path", help="win path (a directory when sending several files)", required=True)
     send_subparser.add_argument("-kp", "--kvm-path", help="kvm path", default="/haka/tmp")
-    send_subparser.add_argument("-e", "--execute", help="execute uploaded file with switches")
+    send_subparser.add_argument("-e", "--execute", help="execute the (first) uploaded file with switches")
     send_subparser.add_argument("-gu", "--guest-user")
     send_subparser.add_argument("-gp", "--guest-pass")
     send_subparser.add_argument("-ws", "--web-server", default="192.168.122.1")
+    send_subparser.add_argument("-j", "--json", action="store_true", help="stream node results as json lines")
+    send_subparser.add_argument("--store-size", default=20, type=float, help="staged file cache size per kvm host in GB")
 
-    reboot_subparser = subparsers.add_parser(
-        "reboot",
-        help="reboot fuzz nodes"
+    for action in LIFECYCLE_ACTIONS:
+        action_subparser = subparsers.add_parser(
+            action,
+            help="{} fuzz nodes".format(action)
+        )
+        action_subparser.add_argument("vhost", nargs="+")
+        action_subparser.add_argument("-n", "--vnode", nargs="+")
+        action_subparser.add_argument("-r", "--rate", default=1.0, type=float, help="actions per second per kvm host")
+        action_subparser.add_argument("-d", "--delay", type=float, help="seconds between actions per kvm host (overrides rate)")
+        action_subparser.add_argument("--wait", choices=["lease", "winrm"], help="wait until nodes are ready again")
+        action_subparser.add_argument("-t", "--timeout", default=600, type=int, help="seconds to wait per node")
+        action_subparser.add_argument("-gu", "--guest-user")
+        action_subparser.add_argument("-gp", "--guest-pass")
+        action_subparser.add_argument("-j", "--json", action="store_true", help="stream node results as json lines")
+
+    reset_subparser = subparsers.add_parser(
+        "reset",
+        help="recreate fuzz node overlays from the base image"
     )
-    reboot_subparser.add_argument("vhost", nargs="+")
-    reboot_subparser.add_argument("-n", "--vnode", nargs="+")
-    reboot_subparser.add_argument("-d", "--delay", default=1, type=int)
+    reset_subparser.add_argument("vhost", nargs="+")
+    reset_subparser.add_argument("-n", "--vnode", nargs="+")
+    reset_subparser.add_argument("-wp", "--work-path", help="kvm work path", default="/haka")
+    reset_subparser.add_argument("-b", "--base-image", help="base image in work path", default="base.qcow2")
 
     command_subparser = subparsers.add_parser(
         "command",
@@ -433,6 +821,7 @@ if __name__ == "__main__":
     command_subparser.add_argument("-n", "--vnode", nargs="+")
     command_subparser.add_argument("-gu", "--guest-user")
     command_subparser.add_argument("-gp", "--guest-pass")
+    command_subparser.add_argument("-j", "--json", action="store_true", help="stream node results as json lines")
 
     view_subparser = subparsers.add_parser(
         "view",
@@ -447,5 +836,25 @@ if __name__ == "__main__":
     )
     list_subparser.add_argument("-f", "--find", help="Node hostname to find")
 
+    health_subparser = subparsers.add_parser(
+        "health",
+        help="probe fuzz node readiness"
+    )
+    health_subparser.add_argument("vhost", nargs="+")
+    health_subparser.add_argument("-n", "--vnode", nargs="+")
+    health_subparser.add_argument("-gu", "--guest-user")
+    health_subparser.add_argument("-gp", "--guest-pass")
+    health_subparser.add_argument("--no-winrm", action="store_true", help="skip the winrm login check")
+    health_subparser.add_argument("--port", default=winrmpool.WINRM_PORT, type=int, help="node port to check")
+    health_subparser.add_argument("-t", "--timeout", default=health.CHECK_TIMEOUT, type=int, help="seconds per check")
+    health_subparser.add_argument("--health-ttl", default=health.HEALTH_TTL, type=int, help="seconds to reuse probe results")
+    health_subparser.add_argument("-j", "--json", action="store_true", help="stream node results as json lines")
+
+    refresh_subparser = subparsers.add_parser(
+        "refresh",
+        help="refresh cached inventory"
+    )
+    refresh_subparser.add_argument("vhost", nargs="*")
+
     args = parser.parse_args()
     main(args)
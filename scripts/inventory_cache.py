@@ -0,0 +1,87 @@
+# inventory_cache.py - on-disk snapshot of kvm host inventories
+#   keeps the kvm host list and per host node entries between runs
+import json
+import os
+import tempfile
+import time
+
+CACHE_TTL = 300
+
+
+class InventoryCache(object):
+    """
+    json snapshot of node inventories keyed by kvm host
+
+    {
+        "hosts_path": "...", "hosts_mtime": 0.0, "kvm_hosts": [ ... ],
+        "entries": { "<kvm host>": { "updated": 0.0, "nodes": [ ... ],
+                                     "macs": { "<uuid>:<id>": "<mac>" } } },
+        "health": { "<kvm host>/<domain>": { "healthy": true, "checked": 0.0, ... } }
+    }
+    """
+    def __init__(self, path, ttl=CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.data = self._read()
+
+    def _read(self):
+        try:
+            with open(self.path, "rb") as fp:
+                data = json.load(fp)
+        except (IOError, ValueError):
+            data = {}
+        data.setdefault("entries", {})
+        data.setdefault("health", {})
+        return data
+
+    def save(self):
+        """
+        merges with the snapshot on disk, keeping the newest entry per
+        host, and atomically replaces it
+        """
+        disk = self._read()
+        for host, entry in disk["entries"].iteritems():
+            mine = self.data["entries"].get(host)
+            if mine is None or mine["updated"] < entry["updated"]:
+                self.data["entries"][host] = entry
+        for key, result in disk["health"].iteritems():
+            mine = self.data["health"].get(key)
+            if mine is None or mine["checked"] < result["checked"]:
+                self.data["health"][key] = result
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".inventory")
+        with os.fdopen(fd, "wb") as fp:
+            json.dump(self.data, fp, separators=(",", ":"))
+        os.rename(tmp, self.path)
+
+    def kvm_hosts(self, hosts_path):
+        """
+        returns the cached kvm host list, or None if the ansible hosts
+        file changed since it was cached
+        """
+        try:
+            mtime = os.path.getmtime(hosts_path)
+        except OSError:
+            return None
+        if self.data.get("hosts_path") != hosts_path or self.data.get("hosts_mtime") != mtime:
+            return None
+        return self.data.get("kvm_hosts")
+
+    def set_kvm_hosts(self, hosts_path, hosts):
+        self.data["hosts_path"] = hosts_path
+        self.data["hosts_mtime"] = os.path.getmtime(hosts_path)
+        self.data["kvm_hosts"] = hosts
+
+    def get(self, host):
+        return self.data["entries"].get(host)
+
+    def put(self, host, nodes, macs=None):
+        self.data["entries"][host] = {
+            "updated": time.time(),
+            "nodes": nodes,
+            "macs": macs or {}
+        }
+
+    def stale(self, host):
+        entry = self.get(host)
+        return entry is None or time.time() - entry["updated"] > self.ttl
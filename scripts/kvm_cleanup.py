@@ -34,7 +34,7 @@ def delete_overlay_templates(path, wipe=False):
             except OSError:
                 pass
         else:
-            if item.endswith((".ovl", ".xmlovl")):
+            if item.endswith((".ovl", ".xmlovl", ".state.json")):
                 os.remove(full)
 
 def main(args):
@@ -1,10 +1,25 @@
 #!/usr/bin/env python
 # kvm_create_xml.py - populating base xmldesc of libvirt domains
 import argparse
+import collections
+import hashlib
+import json
+import multiprocessing
 import os
+import Queue
+import re
 import subprocess
+import threading
 import time
 import xml.etree.ElementTree as ET
+from xml.sax import saxutils
+
+import libvirt
+
+WORKERS = multiprocessing.cpu_count()
+
+# elements replaced by a Placement
+PLACEMENT_TAGS = ("cputune", "numatune", "memoryBacking")
 
 def cmd(c):
     if isinstance(c, str):
@@ -12,87 +27,555 @@ def cmd(c):
     p = subprocess.Popen(c)
     p.communicate()
 
-def create_ovl(base_image_file, name="BASE", count=1):
+def parallel(fn, items, workers=WORKERS):
+    """ calls fn on each item with at most `workers` running at once """
+    queue = Queue.Queue()
+    for item in items:
+        queue.put(item)
+    errors = []
+
+    def worker():
+        while True:
+            try:
+                item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                fn(item)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [ threading.Thread(target=worker) for _ in xrange(max(1, workers)) ]
+    [ t.start() for t in threads ]
+    [ t.join() for t in threads ]
+    if errors:
+        raise errors[0]
+
+class Pacer(object):
+    """ spaces successive calls to wait() at least `delay` seconds apart """
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.delay:
+            return
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next)
+            self.next = start + self.delay
+        if start > now:
+            time.sleep(start - now)
+
+def create_ovl(base_image_file, name="BASE", count=1, workers=WORKERS, indexes=None):
     """ create storage overlays """
-    qemu_cmd = "qemu-img create -f qcow2 -b {}".format(base_image_file)
+    if indexes is None:
+        indexes = xrange(1, count+1)
+    qemu_cmd = "qemu-img create -f qcow2 -b {} -F qcow2".format(base_image_file)
     base_image_path = os.path.dirname(base_image_file)
-    for i in xrange(count):
-        new_name = "{}-{}.ovl".format(name, i+1)
-        path = os.path.join(base_image_path, new_name)
-        q = "{} {}".format(qemu_cmd, path)
-        cmd(q)
+    paths = [ os.path.join(base_image_path, "{}-{}.ovl".format(name, i))
+              for i in indexes ]
+    parallel(lambda path: cmd("{} {}".format(qemu_cmd, path)), paths, workers)
 
-def create_xml(base_template_file, name="BASE", count=1, mem="4096", cpu="2", disk=None):
-    """ create xml descriptors for overlays"""
-    base_template_path = os.path.dirname(base_template_file)
-    xmldesc = ET.parse(base_template_file).getroot()
-    templates = []
+def host_topology(uri="qemu:///system"):
+    """
+    numa cells of the host from its capabilities
+
+    returns a list of { "id", "cpus": [ cpu ids ], "hugepages": bytes }
+    """
+    conn = libvirt.open(uri)
+    try:
+        caps = ET.fromstring(conn.getCapabilities())
+    finally:
+        conn.close()
+    cells = []
+    for cell in caps.findall("./host/topology/cells/cell"):
+        hugepages = 0
+        for pages in cell.findall("./pages"):
+            size = int(pages.attrib["size"])
+            # the base page size is listed too
+            if size > 4:
+                hugepages += size * 1024 * int(pages.text)
+        cells.append({
+            "id": int(cell.attrib["id"]),
+            "cpus": [ int(c.attrib["id"]) for c in cell.findall("./cpus/cpu") ],
+            "hugepages": hugepages
+        })
+    return cells
+
+class Placement(object):
+    """
+    spreads domains round-robin across numa cells
+
+    mode "numa" keeps each domain's vcpus, emulator and memory on its
+    cell; "pinned" also pins every vcpu to its own host cpu in the cell,
+    wrapping around once the cell's cpus are used up
+
+    memory is backed by hugepages when every cell has enough of them
+    for the domains placed on it
+    """
+    def __init__(self, cells, mode="numa", cpu=2, mem=4096, indexes=(), hugepages=True):
+        self.cells = cells
+        self.mode = mode
+        self.cpu = int(cpu)
+        self.rendered = {}
+        per_cell = collections.Counter(self.cell(i)["id"] for i in indexes)
+        self.hugepages = hugepages and bool(per_cell) and all(
+            cell["hugepages"] >= per_cell[cell["id"]] * (int(mem) << 20) for cell in cells)
+
+    def cell(self, index):
+        return self.cells[(index - 1) % len(self.cells)]
+
+    def pins(self, index):
+        """ host cpuset of each vcpu """
+        cell = self.cell(index)
+        if self.mode != "pinned":
+            return [ ",".join(str(c) for c in cell["cpus"]) ] * self.cpu
+        slot = (index - 1) // len(self.cells)
+        return [ str(cell["cpus"][(slot * self.cpu + vcpu) % len(cell["cpus"])])
+                 for vcpu in xrange(self.cpu) ]
 
-    for i in xrange(count):
-        new_name = "{}-{}".format(name, i+1)
-        filename = new_name + ".xmlovl"
-        dom = xmldesc.copy()
-        dom.find("./name").text = new_name
-        dom.find("./memory").text = str(mem)
-        dom.find("./currentMemory").text = str(mem)
-        dom.find("./vcpu").text = str(cpu)
+    def elements(self, index):
+        """ cputune, numatune and memoryBacking elements for a domain """
+        cell = self.cell(index)
+        cpuset = ",".join(str(c) for c in cell["cpus"])
 
+        cputune = ET.Element("cputune")
+        for vcpu, pin in enumerate(self.pins(index)):
+            ET.SubElement(cputune, "vcpupin", vcpu=str(vcpu), cpuset=pin)
+        ET.SubElement(cputune, "emulatorpin", cpuset=cpuset)
+
+        numatune = ET.Element("numatune")
+        ET.SubElement(numatune, "memory", mode="strict", nodeset=str(cell["id"]))
+        elements = [ cputune, numatune ]
+
+        if self.hugepages:
+            backing = ET.Element("memoryBacking")
+            ET.SubElement(backing, "hugepages")
+            elements.append(backing)
+        return elements
+
+    def xml(self, index):
+        """
+        elements for a domain serialized, for compiled templates; domains
+        sharing a cell and pins share the text
+        """
+        key = (self.cell(index)["id"], tuple(self.pins(index)))
+        if key not in self.rendered:
+            self.rendered[key] = "".join(ET.tostring(e) for e in self.elements(index))
+        return self.rendered[key]
+
+def host_placement(mode, cpu, mem, indexes, uri="qemu:///system"):
+    """ Placement for the host, or None when disabled or without numa info """
+    if mode == "none":
+        return None
+    cells = host_topology(uri)
+    if not cells:
+        print "[-] no numa topology reported, placement disabled"
+        return None
+    return Placement(cells, mode, cpu, mem, indexes)
+
+def _xml_value(value):
+    return saxutils.escape(str(value), { '"': "&quot;" })
+
+def _compile(dom, placement=False):
+    """ serializes dom into a format string with the node fields as keys """
+    dom.find("./name").text = "__NAME__"
+    dom.find("./memory").text = "__MEMORY__"
+    dom.find("./currentMemory").text = "__MEMORY__"
+    dom.find("./vcpu").text = "__VCPU__"
+    dom.find("./devices/disk/source").attrib["file"] = "__DISK__"
+    text = ET.tostring(dom).replace("%", "%%")
+    if placement:
+        end = text.rindex("</domain>")
+        text = text[:end] + "__PLACEMENT__" + text[end:]
+    for field in ("NAME", "MEMORY", "VCPU", "DISK", "PLACEMENT"):
+        text = text.replace("__{}__".format(field), "%({})s".format(field.lower()))
+    return text
+
+class DomainTemplate(object):
+    """
+    domain xml compiled once into format strings
+
+    name, memory, vcpu and disk become placeholders (as template.py
+    writes them), so rendering a domain is one string substitution
+    rather than a tree copy, lookups and serialization; the placed
+    variant has the placement elements stripped and a slot for them
+    """
+    def __init__(self, xml):
+        dom = ET.fromstring(xml)
+        self.text = _compile(dom)
+        for tag in PLACEMENT_TAGS:
+            for old in dom.findall(tag):
+                dom.remove(old)
+        self.placed = _compile(dom, placement=True)
+
+    def render(self, name, mem, cpu, disk, placement=None):
+        values = {
+            "name": _xml_value(name),
+            "memory": _xml_value(mem),
+            "vcpu": _xml_value(cpu),
+            "disk": _xml_value(disk)
+        }
+        if placement is None:
+            return self.text % values
+        values["placement"] = placement
+        return self.placed % values
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+def compile_template(base_template_file):
+    """ DomainTemplate of a template file, cached by the file's sha256 """
+    with open(base_template_file, "rb") as fp:
+        xml = fp.read()
+    key = hashlib.sha256(xml).hexdigest()
+    with _templates_lock:
+        if key not in _templates:
+            _templates[key] = DomainTemplate(xml)
+        return _templates[key]
+
+def render_xml(base_template_file, name="BASE", count=1, mem="4096", cpu="2", disk=None,
+               indexes=None, placement=None):
+    """ xml descriptors for overlays, as an ordered dict of domain name to xml """
+    if indexes is None:
+        indexes = xrange(1, count+1)
+    base_template_path = os.path.dirname(base_template_file)
+    template = compile_template(base_template_file)
+    domains = collections.OrderedDict()
+
+    for i in indexes:
+        new_name = "{}-{}".format(name, i)
         # use disk value as an override, else point to generated overlay
-        if disk:
-            diskpath = disk
-        else:
-            diskpath = os.path.join(base_template_path, new_name + ".ovl")
+        diskpath = disk or os.path.join(base_template_path, new_name + ".ovl")
+        domains[new_name] = template.render(
+            new_name, mem, cpu, diskpath,
+            placement.xml(i) if placement is not None else None)
+    return domains
 
-        dom.find("./devices/disk/source").attrib["file"] = diskpath
-        output_path = os.path.join(base_template_path, filename)
+def create_xml(base_template_file, name="BASE", count=1, mem="4096", cpu="2", disk=None,
+               indexes=None, placement=None):
+    """ create xml descriptors for overlays"""
+    base_template_path = os.path.dirname(base_template_file)
+    templates = []
+    for new_name, xml in render_xml(base_template_file, name, count, mem, cpu, disk,
+                                    indexes, placement).iteritems():
+        output_path = os.path.join(base_template_path, new_name + ".xmlovl")
         with open(output_path, "wb") as f:
-            f.write(ET.tostring(dom))
+            f.write(xml)
         templates.append(output_path)
     return templates
 
-def create_vms(templates=[], is_temporary=False):
-    """ create kvm domains based on templates"""
-    virt_cmd = "virsh -c qemu:///system"
+def create_vms(templates=[], is_temporary=False, workers=WORKERS, pace=0,
+               uri="qemu:///system"):
+    """
+    create kvm domains based on templates
+
+    templates are descriptor files or a dict of domain name to xml
+    (render_xml), which is defined directly
+
+    returns the templates (domain names for a dict) that failed to
+    define or start
+    """
+    conn = libvirt.open(uri)
+    pacer = Pacer(pace)
+    failed = []
+
+    def create(template):
+        if isinstance(template, tuple):
+            label, xml = template
+        else:
+            label = os.path.basename(template)
+            with open(template, "rb") as fp:
+                xml = fp.read()
+        try:
+            # define vm
+            if is_temporary:
+                pacer.wait()
+                conn.createXML(xml, 0)
+            else:
+                dom = conn.defineXML(xml)
+                dom.setAutostart(1)
+                pacer.wait()
+                dom.create()
+        except libvirt.libvirtError as e:
+            print "[-] {}: {}".format(label, e)
+            failed.append(label)
+
+    if isinstance(templates, dict):
+        templates = templates.items()
+    try:
+        parallel(create, templates, workers)
+    finally:
+        conn.close()
+    return failed
+
+def remove_vms(conn, domains, path, workers=WORKERS):
+    """ destroy and undefine domains, deleting their overlay and descriptor """
+    def remove(dom):
+        name = dom.name()
+        try:
+            dom.destroy()
+        except libvirt.libvirtError:
+            # domain already stopped
+            pass
+        # fuzz nodes carry snapshots, which block a plain undefine
+        dom.undefineFlags(libvirt.VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA)
+        for ext in (".ovl", ".xmlovl"):
+            filename = os.path.join(path, name + ext)
+            if os.path.exists(filename):
+                os.remove(filename)
+    parallel(remove, domains, workers)
+
+def reset_vms(base_image_file, names, workers=WORKERS, uri="qemu:///system"):
+    """
+    swap the overlay of each named domain for a fresh one on the base image
+
+    domain definitions are kept; snapshot metadata is dropped since the
+    snapshots lived in the old overlay
+    """
+    conn = libvirt.open(uri)
+
+    def reset(name):
+        dom = conn.lookupByName(name)
+        xml = ET.fromstring(dom.XMLDesc())
+        path = xml.find("./devices/disk/source").attrib["file"]
+        try:
+            dom.destroy()
+        except libvirt.libvirtError:
+            # domain already stopped
+            pass
+        for snapshot in dom.listAllSnapshots():
+            snapshot.delete(libvirt.VIR_DOMAIN_SNAPSHOT_DELETE_METADATA_ONLY)
+
+        # build the new overlay aside and swap it in atomically
+        tmp = path + ".tmp"
+        qemu_cmd = "qemu-img create -q -f qcow2 -b {} -F qcow2 {}".format(base_image_file, tmp)
+        subprocess.check_call(qemu_cmd.split())
+        os.rename(tmp, path)
+        dom.create()
+        print "Reset: {}".format(name)
+
+    try:
+        parallel(reset, names, workers)
+    finally:
+        conn.close()
+
+def checksum(path, blocksize=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(blocksize), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def state_path(base_image_file, name):
+    path = os.path.dirname(os.path.abspath(base_image_file))
+    return os.path.join(path, "{}.state.json".format(name))
+
+def load_state(path):
+    """ deployed node specs, keyed by domain name """
+    try:
+        with open(path, "rb") as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return { "nodes": {} }
+
+def save_state(path, state):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as fp:
+        json.dump(state, fp, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+
+def base_checksum(base_image_file, state, sha256=None):
+    """
+    sha256 of the base image, only recomputed when the file changes
 
-    for template in templates:
-        domain = os.path.basename(template).strip(".xmlovl")
-        # define vm
-        if is_temporary:
-            c = "{} create {}".format(virt_cmd, template)
-            cmd(c)
+    a known sha256 (e.g. from the image registry) is taken as is
+    """
+    st = os.stat(base_image_file)
+    cached = state.get("base", {})
+    if sha256 is None and cached.get("size") == st.st_size and cached.get("mtime") == st.st_mtime:
+        return cached["sha256"]
+    digest = sha256 or checksum(base_image_file)
+    state["base"] = { "size": st.st_size, "mtime": st.st_mtime, "sha256": digest }
+    return digest
+
+def desired_state(base_image_file, base_template_file, state, mem, cpu, placement="none",
+                  base_sha256=None):
+    desired = {
+        "base": base_checksum(base_image_file, state, base_sha256),
+        "template": checksum(base_template_file),
+        "vcpu": str(cpu),
+        "vmem": str(mem)
+    }
+    # only recorded when used so existing state stays current
+    if placement != "none":
+        desired["placement"] = placement
+    return desired
+
+def reconcile(base_image_file, base_template_file, name="BASE", count=1, mem="4096",
+              cpu="2", workers=WORKERS, pace=0, uri="qemu:///system", placement="none",
+              base_sha256=None):
+    """
+    bring deployed nodes in line with the desired spec
+
+    nodes are added or removed to match count; nodes whose base image
+    changed get a fresh overlay, nodes whose template or specs changed
+    are redefined and restarted, and everything else is left running
+    """
+    path = state_path(base_image_file, name)
+    state = load_state(path)
+    desired = desired_state(base_image_file, base_template_file, state, mem, cpu, placement,
+                            base_sha256)
+
+    conn = libvirt.open(uri)
+    pattern = re.compile(r"^{}-(\d+)$".format(re.escape(name)))
+    existing = {}
+    for dom in conn.listAllDomains():
+        match = pattern.match(dom.name())
+        if match:
+            existing[int(match.group(1))] = dom
+
+    wanted = set(xrange(1, count+1))
+    add = sorted(wanted - set(existing))
+    remove = sorted(set(existing) - wanted)
+    rebuild, redefine = [], []
+    for i in sorted(wanted & set(existing)):
+        # nodes without recorded state are treated as out of date
+        current = state["nodes"].get("{}-{}".format(name, i))
+        if current is None or current["base"] != desired["base"]:
+            rebuild.append(i)
+        elif current != desired:
+            redefine.append(i)
+
+    print "add: {} remove: {} rebuild: {} redefine: {} unchanged: {}".format(
+        len(add), len(remove), len(rebuild), len(redefine),
+        len(wanted) - len(add) - len(rebuild) - len(redefine))
+
+    try:
+        base_template_path = os.path.dirname(base_template_file)
+        remove_vms(conn, [ existing[i] for i in remove ], base_template_path, workers)
+        for i in remove:
+            state["nodes"].pop("{}-{}".format(name, i), None)
+
+        def stop(dom):
+            try:
+                dom.destroy()
+            except libvirt.libvirtError:
+                # domain already stopped
+                pass
+        parallel(stop, [ existing[i] for i in rebuild + redefine ], workers)
+
+        # snapshots lived in the overlays about to be replaced
+        def drop_snapshots(dom):
+            for snapshot in dom.listAllSnapshots():
+                snapshot.delete(libvirt.VIR_DOMAIN_SNAPSHOT_DELETE_METADATA_ONLY)
+        parallel(drop_snapshots, [ existing[i] for i in rebuild ], workers)
+    finally:
+        conn.close()
+
+    create_ovl(base_image_file, name=name, workers=workers, indexes=add + rebuild)
+    # hugepages are sized against every wanted node, not just the ones changing
+    layout = host_placement(placement, cpu, mem, wanted, uri)
+    domains = render_xml(
+        base_template_file,
+        name = name,
+        mem = mem,
+        cpu = cpu,
+        indexes = add + rebuild + redefine,
+        placement = layout
+    )
+    failed = create_vms(domains, workers=workers, pace=pace, uri=uri)
+
+    # nodes that failed to start are left out so the next run retries them
+    for i in add + rebuild + redefine:
+        node = "{}-{}".format(name, i)
+        if node in failed:
+            state["nodes"].pop(node, None)
         else:
-            c = "{} define {}".format(virt_cmd, template)
-            cmd(c)
-            a = "{} autostart {}".format(virt_cmd, domain)
-            cmd(a)
-            s = "{} start {}".format(virt_cmd, domain)
-            cmd(s)
-        time.sleep(1)
+            state["nodes"][node] = desired
+    save_state(path, state)
 
 def main(args):
+    if args.reset:
+        reset_vms(args.base_image, args.reset, workers=args.jobs)
+
+        # reset nodes now sit on the current base image, recorded in the
+        # state of their deploy (<node_name>-<i> -> <node_name>.state.json)
+        prefixes = collections.defaultdict(list)
+        for name in args.reset:
+            prefixes[name.rsplit("-", 1)[0]].append(name)
+        for prefix, names in prefixes.iteritems():
+            path = state_path(args.base_image, prefix)
+            if not os.path.exists(path):
+                continue
+            state = load_state(path)
+            digest = base_checksum(args.base_image, state, args.base_sha256)
+            for name in names:
+                if name in state["nodes"]:
+                    state["nodes"][name]["base"] = digest
+            save_state(path, state)
+        return
+
+    if args.reconcile:
+        reconcile(
+            base_image_file = args.base_image,
+            base_template_file = os.path.abspath(args.base_template),
+            name = args.name,
+            count = args.count,
+            mem = args.mem,
+            cpu = args.cpu,
+            workers = args.jobs,
+            pace = args.pace,
+            placement = args.placement,
+            base_sha256 = args.base_sha256
+        )
+        return
+
     create_ovl(
         name = args.name,
         base_image_file = args.base_image,
-        count = args.count
+        count = args.count,
+        workers = args.jobs
     )
 
-    templates = create_xml(
+    layout = host_placement(args.placement, args.cpu, args.mem, xrange(1, args.count+1))
+    domains = render_xml(
         base_template_file = os.path.abspath(args.base_template),
         name = args.name,
         count = args.count,
         mem = args.mem,
-        cpu = args.cpu
+        cpu = args.cpu,
+        placement = layout
     )
-    create_vms(templates = templates)
+    failed = create_vms(templates = domains, workers = args.jobs, pace = args.pace)
+
+    # record what was deployed for later --reconcile runs
+    path = state_path(args.base_image, args.name)
+    state = load_state(path)
+    desired = desired_state(args.base_image, args.base_template, state, args.mem, args.cpu,
+                            args.placement, args.base_sha256)
+    state["nodes"] = dict((node, desired) for node in domains if node not in failed)
+    save_state(path, state)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("base_image", help="Base QCOW2 Image File")
-    parser.add_argument("base_template", help="Base XMLDesc Template File")
+    parser.add_argument("base_template", nargs="?", help="Base XMLDesc Template File")
     parser.add_argument("-c", "--count", default=1, type=int)
     parser.add_argument("-n", "--name", default="BASE")
     parser.add_argument("--mem", default="4096")
     parser.add_argument("--cpu", default="2")
+    parser.add_argument("-j", "--jobs", default=WORKERS, type=int, help="parallel overlay/domain operations")
+    parser.add_argument("--pace", default=0, type=float, help="seconds between domain starts")
+    parser.add_argument("-r", "--reconcile", action="store_true", help="only add, remove or update nodes that differ")
+    parser.add_argument("--placement", default="none", choices=["none", "numa", "pinned"],
+                        help="spread domains across numa cells, optionally pinning vcpus")
+    parser.add_argument("--base-sha256", help="known sha256 of the base image, skips hashing it")
+    parser.add_argument("--reset", nargs="+", metavar="DOMAIN", help="recreate overlays of these domains in place")
     args = parser.parse_args()
+    if not args.reset and args.base_template is None:
+        parser.error("base_template is required")
 
     main(args)
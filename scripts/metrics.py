@@ -0,0 +1,191 @@
+# metrics.py - per domain resource sampling for webvirt
+#   one getAllDomainStats call per interval covers every running domain;
+#   samples are kept in a fixed size ring buffer for rates and summaries
+import collections
+import logging
+import threading
+import time
+
+import libvirt
+
+SAMPLE_INTERVAL = 15
+SAMPLE_COUNT = 240
+
+STATS = (
+    libvirt.VIR_DOMAIN_STATS_STATE |
+    libvirt.VIR_DOMAIN_STATS_CPU_TOTAL |
+    libvirt.VIR_DOMAIN_STATS_BALLOON |
+    libvirt.VIR_DOMAIN_STATS_VCPU |
+    libvirt.VIR_DOMAIN_STATS_INTERFACE |
+    libvirt.VIR_DOMAIN_STATS_BLOCK
+)
+
+# (metric, help, type, sample key)
+DOMAIN_METRICS = (
+    ("cpu_seconds_total", "guest cpu time", "counter", "cpu_seconds"),
+    ("vcpus", "current vcpus", "gauge", "vcpus"),
+    ("memory_balloon_bytes", "balloon size", "gauge", "balloon"),
+    ("memory_max_bytes", "maximum memory", "gauge", "memory_max"),
+    ("memory_rss_bytes", "qemu resident memory", "gauge", "rss"),
+    ("block_read_bytes_total", "bytes read from disks", "counter", "rd_bytes"),
+    ("block_write_bytes_total", "bytes written to disks", "counter", "wr_bytes"),
+    ("block_read_requests_total", "disk read requests", "counter", "rd_reqs"),
+    ("block_write_requests_total", "disk write requests", "counter", "wr_reqs"),
+    ("net_rx_bytes_total", "bytes received", "counter", "rx_bytes"),
+    ("net_tx_bytes_total", "bytes sent", "counter", "tx_bytes")
+)
+
+
+def _sum(stats, prefix, field):
+    count = stats.get("{}.count".format(prefix), 0)
+    return sum(stats.get("{}.{}.{}".format(prefix, i, field), 0) for i in xrange(count))
+
+
+def domain_sample(stats):
+    """ flattens a getAllDomainStats record, sizes in bytes """
+    return {
+        "state": stats.get("state.state"),
+        "cpu_seconds": stats.get("cpu.time", 0) / 1e9,
+        "vcpus": stats.get("vcpu.current", 0),
+        "balloon": stats.get("balloon.current", 0) * 1024,
+        "memory_max": stats.get("balloon.maximum", 0) * 1024,
+        "rss": stats.get("balloon.rss", 0) * 1024,
+        "rd_bytes": _sum(stats, "block", "rd.bytes"),
+        "wr_bytes": _sum(stats, "block", "wr.bytes"),
+        "rd_reqs": _sum(stats, "block", "rd.reqs"),
+        "wr_reqs": _sum(stats, "block", "wr.reqs"),
+        "rx_bytes": _sum(stats, "net", "rx.bytes"),
+        "tx_bytes": _sum(stats, "net", "tx.bytes")
+    }
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+class Collector(object):
+    """
+    samples host and domain stats every interval seconds, keeping the
+    last size samples:
+
+        { "time": 0.0,
+          "host": { "cpus": 0, "memory": 0, "free": 0 },
+          "domains": { "<name>": { ... domain_sample ... } } }
+    """
+    def __init__(self, pool, interval=SAMPLE_INTERVAL, size=SAMPLE_COUNT):
+        self.pool = pool
+        self.interval = interval
+        self.samples = collections.deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def sample(self):
+        with self.pool.connection() as conn:
+            _, memory, cpus = conn.getInfo()[:3]
+            free = conn.getFreeMemory()
+            stats = conn.getAllDomainStats(STATS, libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+            domains = dict((dom.name(), domain_sample(s)) for dom, s in stats)
+        sample = {
+            "time": time.time(),
+            "host": { "cpus": cpus, "memory": memory << 20, "free": free },
+            "domains": domains
+        }
+        with self.lock:
+            self.samples.append(sample)
+        return sample
+
+    def _run(self):
+        while True:
+            try:
+                self.sample()
+            except libvirt.libvirtError as e:
+                logging.error("Failed to sample domain stats:\n{}".format(e))
+            if self.done.wait(self.interval):
+                return
+
+    def start(self):
+        t = threading.Thread(name="metrics", target=self._run)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self.done.set()
+
+    def window(self):
+        with self.lock:
+            return list(self.samples)
+
+    def prometheus(self, host="kvm"):
+        """ latest sample in prometheus text exposition format """
+        samples = self.window()
+        if not samples:
+            return ""
+        latest = samples[-1]
+        lines = []
+        for name, key in (("cpus", "cpus"), ("memory_bytes", "memory"), ("memory_free_bytes", "free")):
+            lines.append("# TYPE webvirt_host_{} gauge".format(name))
+            lines.append('webvirt_host_{}{{host="{}"}} {}'.format(name, host, latest["host"][key]))
+        for name, desc, kind, key in DOMAIN_METRICS:
+            lines.append("# HELP webvirt_domain_{} {}".format(name, desc))
+            lines.append("# TYPE webvirt_domain_{} {}".format(name, kind))
+            for domain, sample in sorted(latest["domains"].iteritems()):
+                lines.append('webvirt_domain_{}{{host="{}",domain="{}"}} {}'.format(
+                    name, host, domain, sample[key]))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        allocation and observed use of the host over the sample window
+
+        cpu use is in cores, from cpu time deltas between samples; the
+        overcommit ratios compare allocated vcpus and memory to the host
+        """
+        samples = self.window()
+        if not samples:
+            return None
+        latest = samples[-1]
+        host = latest["host"]
+        domains = latest["domains"]
+
+        # per interval cpu use, total and per domain
+        used, per_domain = [], collections.defaultdict(list)
+        for prev, cur in zip(samples, samples[1:]):
+            elapsed = cur["time"] - prev["time"]
+            total = 0
+            for name, s in cur["domains"].iteritems():
+                before = prev["domains"].get(name)
+                if before is None or s["cpu_seconds"] < before["cpu_seconds"]:
+                    # started or restarted during the interval
+                    continue
+                cores = (s["cpu_seconds"] - before["cpu_seconds"]) / elapsed
+                per_domain[name].append(cores)
+                total += cores
+            used.append(total)
+
+        vcpus = sum(s["vcpus"] for s in domains.itervalues())
+        memory = sum(s["memory_max"] for s in domains.itervalues())
+        rss = sum(s["rss"] for s in domains.itervalues())
+        guest_cpu = [ sum(v) / len(v) for v in per_domain.itervalues() ]
+        return {
+            "window": round(latest["time"] - samples[0]["time"], 1),
+            "samples": len(samples),
+            "domains": len(domains),
+            "host_cpus": host["cpus"],
+            "host_memory": host["memory"],
+            "host_free": host["free"],
+            "vcpus": vcpus,
+            "memory": memory,
+            "rss": rss,
+            "cpu_overcommit": round(vcpus / float(host["cpus"]), 2),
+            "memory_overcommit": round(memory / float(host["memory"]), 2),
+            "cpu_used_avg": round(sum(used) / len(used), 2) if used else 0,
+            "cpu_used_p95": round(_percentile(used, 95), 2),
+            "guest_cpu_avg": round(sum(guest_cpu) / len(guest_cpu), 3) if guest_cpu else 0,
+            "guest_rss_avg": rss / len(domains) if domains else 0,
+            "cpu_saturated": _percentile(used, 95) > 0.9 * host["cpus"],
+            "memory_saturated": host["free"] < 0.1 * host["memory"]
+        }
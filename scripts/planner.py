@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# planner.py - suggest node_count per kvm host from its hardware
+#   reads cpus, numa cells and memory over libvirt and free disk over ssh,
+#   optionally tightened by guest use observed by webvirt, and can write
+#   the result back to the [kvm] section of the ansible hosts file
+import argparse
+import json
+import os
+import pipes
+import re
+import sys
+import xml.etree.ElementTree as ET
+import yaml
+
+import libvirt
+
+import fanout
+import sshpool
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+ANSIBLE_PATH = os.path.dirname(BASE_PATH)
+HOST_PATH = os.path.join(ANSIBLE_PATH, "hosts")
+VARS_PATH = os.path.join(ANSIBLE_PATH, "group_vars", "gunsen.yml")
+
+SUMMARY_URL = "http://192.168.122.1:8080/metrics/summary"
+
+
+def read_kvm_section(hosts_path):
+    """
+    returns an ordered list of (host, vars) in the [kvm] section
+    """
+    hosts, section = [], None
+    with open(hosts_path, "rb") as fp:
+        for line in fp:
+            line = line.strip()
+            if line.startswith("["):
+                section = line.strip("[]")
+            elif section == "kvm" and line and not line.startswith("#"):
+                fields = line.split()
+                hosts.append((fields[0], dict(f.split("=", 1) for f in fields[1:] if "=" in f)))
+    return hosts
+
+
+def write_node_counts(hosts_path, counts):
+    """
+    sets node_count=<n> on the [kvm] lines of the hosts file, keeping
+    everything else (comments, spacing, other vars) as it is
+    """
+    with open(hosts_path, "rb") as fp:
+        lines = fp.readlines()
+
+    section = None
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        if stripped.startswith("["):
+            section = stripped.strip("[]")
+            continue
+        if section != "kvm" or not stripped or stripped.startswith("#"):
+            continue
+        host = stripped.split()[0]
+        if host not in counts:
+            continue
+        if re.search(r"\bnode_count=\S+", line):
+            line = re.sub(r"\bnode_count=\S+", "node_count={}".format(counts[host]), line)
+        else:
+            line = line.rstrip("\n") + "  node_count={}\n".format(counts[host])
+        lines[i] = line
+
+    tmp = hosts_path + ".tmp"
+    with open(tmp, "wb") as fp:
+        fp.writelines(lines)
+    os.rename(tmp, hosts_path)
+
+
+def numa_cells(conn):
+    """
+    returns a list of (cpus, memory bytes) per numa cell, from capabilities
+    """
+    caps = ET.fromstring(conn.getCapabilities())
+    cells = []
+    for cell in caps.findall("./host/topology/cells/cell"):
+        memory = cell.find("memory")
+        size = int(memory.text) * 1024 if memory is not None else 0
+        cells.append((len(cell.findall("./cpus/cpu")), size))
+    return cells
+
+
+def disk_free(ssh, path):
+    """ returns (available, total) bytes of the filesystem holding path """
+    out, err, status = ssh.exec_command("df -P -B1 {}".format(pipes.quote(path)))
+    if status != 0:
+        raise IOError("df {} failed: {}".format(path, err.strip()))
+    fields = out.strip().splitlines()[-1].split()
+    return (int(fields[3]), int(fields[1]))
+
+
+def observed_summary(ssh, url=SUMMARY_URL):
+    """ webvirt metrics summary, fetched on the kvm host """
+    out, _, status = ssh.exec_command("curl -sf {}".format(pipes.quote(url)))
+    if status != 0 or not out.strip():
+        return None
+    return json.loads(out)
+
+
+def host_facts(user, host, pool, work_path, observe=True):
+    """
+    gathers everything the plan needs from one kvm host
+    """
+    conn = libvirt.open("qemu+ssh://{}@{}/system".format(user, host))
+    try:
+        _, memory, cpus = conn.getInfo()[:3]
+        cells = numa_cells(conn)
+        domains = len(conn.listAllDomains())
+    finally:
+        conn.close()
+
+    ssh = pool.get(host, user)
+    avail, total = disk_free(ssh, work_path)
+    return {
+        "cpus": cpus,
+        "memory": memory << 20,
+        "cells": cells or [(cpus, memory << 20)],
+        "domains": domains,
+        "disk_avail": avail,
+        "disk_total": total,
+        "observed": observed_summary(ssh) if observe else None
+    }
+
+
+def plan(facts, vcpu, vmem, disk, cpu_ratio=4.0, mem_ratio=1.0, reserve=2 << 30,
+         target_util=0.8):
+    """
+    returns (node_count, limiting resource, limits per resource)
+
+    guests are packed per numa cell so none spans cells: each cell gets
+    its share of the host memory reserve and holds as many guests as its
+    cpus and memory allow under the overcommit ratios
+
+    observed use (webvirt summary) can only lower the cpu and memory
+    limits: cpu to keep average guest load under target_util of the
+    cores, memory to what guest rss actually fits in
+    """
+    cpu_limit, mem_limit = 0, 0
+    for cell_cpus, cell_memory in facts["cells"]:
+        usable = cell_memory - reserve * cell_memory / float(facts["memory"])
+        cpu_limit += int(cell_cpus * cpu_ratio / vcpu)
+        mem_limit += int(max(usable, 0) * mem_ratio / vmem)
+
+    observed = facts.get("observed")
+    if observed:
+        if observed.get("guest_cpu_avg"):
+            cpu_limit = min(cpu_limit, int(facts["cpus"] * target_util / observed["guest_cpu_avg"]))
+        if observed.get("guest_rss_avg") and mem_ratio > 1:
+            usable = facts["memory"] - reserve
+            mem_limit = min(mem_limit, int(usable / observed["guest_rss_avg"]))
+
+    # existing overlays already use part of the disk
+    disk_limit = int((facts["disk_avail"] + facts["domains"] * disk) / disk)
+
+    limits = {"cpu": cpu_limit, "memory": mem_limit, "disk": disk_limit}
+    limiting = min(limits, key=limits.get)
+    return (max(limits[limiting], 0), limiting, limits)
+
+
+def node_spec(vars_path, vcpu=None, vmem=None):
+    """ node_vcpu / node_vmem (MB) from group vars unless given """
+    if vcpu is None or vmem is None:
+        with open(vars_path, "rb") as fp:
+            group = yaml.load(fp.read(), Loader=yaml.Loader)
+        vcpu = vcpu or int(group["node_vcpu"])
+        vmem = vmem or int(group["node_vmem"])
+    return (vcpu, vmem)
+
+
+def main(args):
+    vcpu, vmem = node_spec(args.vars_path, args.vcpu, args.vmem)
+    hosts = read_kvm_section(args.hosts_path)
+    if args.vhost:
+        hosts = [(host, hvars) for host, hvars in hosts if host in args.vhost]
+
+    observed = {}
+    if args.observed:
+        # summaries saved earlier, keyed by kvm host
+        with open(args.observed, "rb") as fp:
+            observed = json.load(fp)
+
+    pool = sshpool.SSHPool()
+    fan = fanout.FanOut(workers=args.workers, per_host=1)
+    for host, _ in hosts:
+        fan.submit(host, host_facts, args.user, host, pool, args.work_path,
+                   observe=args.observe and host not in observed)
+
+    current = dict(hosts)
+    counts = {}
+    print "{:<16}{:>6}{:>8}{:>6}{:>10}{:>8}{:>8}{:>8}{:>8}  {}".format(
+        "host", "cpus", "mem GB", "numa", "disk GB", "cpu", "memory", "disk", "count", "(current)")
+    for task in sorted(fan.run(), key=lambda t: t.host):
+        if task.error is not None:
+            sys.stderr.write("[-] {} - {}\n".format(task.host, repr(task.error)))
+            continue
+        facts = task.result
+        if task.host in observed:
+            facts["observed"] = observed[task.host]
+        count, limiting, limits = plan(
+            facts, vcpu, vmem << 20, args.disk << 30,
+            cpu_ratio=args.cpu_ratio,
+            mem_ratio=args.mem_ratio,
+            reserve=args.reserve << 30,
+            target_util=args.target_util
+        )
+        counts[task.host] = count
+        print "{:<16}{:>6}{:>8.0f}{:>6}{:>10.0f}{:>8}{:>8}{:>8}{:>8}  ({}, {} bound)".format(
+            task.host, facts["cpus"], facts["memory"] / 2.0**30, len(facts["cells"]),
+            facts["disk_avail"] / 2.0**30, limits["cpu"], limits["memory"], limits["disk"],
+            count, current[task.host].get("node_count", "-"), limiting)
+    pool.close()
+
+    if args.write and counts:
+        write_node_counts(args.hosts_path, counts)
+        print "updated node_count in {}".format(args.hosts_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("vhost", nargs="*", help="kvm hosts to plan (default all)")
+    parser.add_argument("-u", "--user", default="srt")
+    parser.add_argument("-H", "--hosts_path", default=HOST_PATH)
+    parser.add_argument("--vars-path", default=VARS_PATH, help="group vars with node_vcpu and node_vmem")
+    parser.add_argument("--vcpu", type=int, help="vcpus per node (default node_vcpu)")
+    parser.add_argument("--vmem", type=int, help="memory per node in MB (default node_vmem)")
+    parser.add_argument("--disk", default=10, type=int, help="overlay growth per node in GB")
+    parser.add_argument("--cpu-ratio", default=4.0, type=float, help="max vcpus per host cpu")
+    parser.add_argument("--mem-ratio", default=1.0, type=float, help="max guest memory per host memory")
+    parser.add_argument("--reserve", default=2, type=int, help="host memory kept free in GB")
+    parser.add_argument("--target-util", default=0.8, type=float, help="max share of host cpus guests should use")
+    parser.add_argument("--observe", action="store_true", help="use guest use observed by webvirt on each host")
+    parser.add_argument("--observed", help="json file of webvirt summaries keyed by kvm host")
+    parser.add_argument("-wp", "--work-path", default="/haka", help="kvm work path holding the overlays")
+    parser.add_argument("-w", "--workers", default=16, type=int)
+    parser.add_argument("--write", action="store_true", help="write node_count back to the hosts file")
+    args = parser.parse_args()
+
+    main(args)
@@ -1,14 +1,18 @@
 #!/usr/bin/env python
 # prepare.py - kicks off local kvm domain deployment for image prep
 import argparse
+import json
 import os
 import shutil
 import subprocess
 import datetime
+import tempfile
+import time
 
 import libvirt
 import kvm_cleanup
 import kvm_create
+import registry
 
 BASE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 ROLE_PATH = os.path.join(BASE_PATH, "roles")
@@ -23,26 +27,126 @@ def cleanup():
     kvm_cleanup.destroy_undefine_domains(conn, "BASE-1")
     kvm_cleanup.delete_overlay_templates(PREPARE_PATH)
 
-def compress():
-    com_src = os.path.join(PREPARE_PATH, PREP_IMAGE_NAME)
-    com_dst = os.path.join(PREPARE_PATH, PREP_IMAGE_NAME + ".old")
+def qemu_img_caps():
+    """
+    convert options supported by the local qemu-img
+
+    coroutines (-m) and out of order writes (-W) parallelize convert,
+    though -W cannot be combined with compression (-c),
+    zstd needs qcow2 compression_type support (qemu 5.1)
+    """
+    p = subprocess.Popen(["qemu-img", "--help"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out, _ = p.communicate()
+    caps = {
+        "coroutines": "-m num_coroutines" in out,
+        "unordered": "[-W]" in out,
+        "zstd": False
+    }
+    tmp = tempfile.mkdtemp()
     try:
-        print "Compressing image ..."
-        shutil.move(com_src, com_dst)
-        compress_cmd = "qemu-img convert -c -O qcow2 {} {}".format(com_dst, com_src)
-        subprocess.check_output(compress_cmd.split())
+        probe = os.path.join(tmp, "probe.qcow2")
+        probe_cmd = "qemu-img create -q -f qcow2 -o compression_type=zstd {} 1M".format(probe)
+        with open(os.devnull, "wb") as nil:
+            caps["zstd"] = subprocess.call(probe_cmd.split(), stdout=nil, stderr=nil) == 0
     finally:
-        if os.path.exists(com_dst):
-            os.remove(com_dst)
+        shutil.rmtree(tmp)
+    return caps
+
+def disk_usage(path):
+    """ bytes allocated on disk, which is what copies of sparse images cost """
+    return os.stat(path).st_blocks * 512
+
+def backing_file(path):
+    """ backing file of a qcow2 image, None for standalone images """
+    info = subprocess.check_output([ "qemu-img", "info", "--output=json", path ])
+    return json.loads(info).get("backing-filename")
+
+def stage(src, dst, mode="overlay"):
+    """
+    makes dst a writable prep image of src without copying it
+
+    overlay - thin qcow2 overlay backed by src, flattened on export
+    reflink - copy-on-write clone, falls back to an overlay when the
+              filesystem does not support reflinks
+    copy    - full copy
+    """
+    if os.path.exists(dst):
+        os.remove(dst)
+    if mode == "reflink":
+        with open(os.devnull, "wb") as nil:
+            if subprocess.call([ "cp", "--reflink=always", src, dst ], stderr=nil) == 0:
+                return
+        print "[-] reflinks unsupported, staging an overlay"
+        mode = "overlay"
+    if mode == "overlay":
+        qemu_cmd = "qemu-img create -q -f qcow2 -b {} -F qcow2 {}".format(os.path.abspath(src), dst)
+        subprocess.check_call(qemu_cmd.split())
+    else:
+        shutil.copy(src, dst)
+
+def convert(src, dst, compress=False, codec="zlib", coroutines=16):
+    """
+    writes a standalone (flattened) copy of src to dst in a single pass,
+    optionally compressed
+
+    zeroed clusters (free space zeroized in the guest) are left out, and
+    convert runs in parallel where qemu-img supports it
 
-def export():
+    returns a tuple of (bytes before, bytes after, seconds)
+    """
+    caps = qemu_img_caps()
+    qemu_cmd = [ "qemu-img", "convert", "-O", "qcow2", "-S", "4k" ]
+    if compress:
+        qemu_cmd += [ "-c" ]
+    if compress and codec == "zstd":
+        if caps["zstd"]:
+            qemu_cmd += [ "-o", "compression_type=zstd" ]
+        else:
+            print "[-] qemu-img lacks zstd compression, using zlib"
+    if caps["coroutines"]:
+        qemu_cmd += [ "-m", str(coroutines) ]
+    # qemu-img rejects out of order writes with compression
+    if caps["unordered"] and not compress:
+        qemu_cmd += [ "-W" ]
+
+    # an overlay's size is its own plus what it reads from its backing file
+    before = disk_usage(src)
+    backing = backing_file(src)
+    if backing is not None:
+        before += disk_usage(backing)
+
+    tmp = dst + ".tmp"
+    started = time.time()
+    try:
+        print "Compressing image ..." if compress else "Flattening image ..."
+        subprocess.check_call(qemu_cmd + [ src, tmp ])
+        os.rename(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return (before, disk_usage(dst), time.time() - started)
+
+def export(compress_image=False, codec="zlib", coroutines=16):
     name, ext = PREP_IMAGE_NAME.split(".")
     image_name = "{}.{}.qcow2".format(name, datetime.datetime.now().strftime("%Y%m%d"))
     exp_src = os.path.join(PREPARE_PATH, PREP_IMAGE_NAME)
     exp_dst = os.path.join(DEPLOY_PATH, image_name)
     if os.path.exists(exp_src):
-        shutil.move(exp_src, exp_dst)
+        if compress_image or backing_file(exp_src) is not None:
+            # convert straight into the deploy path instead of moving twice
+            before, after, elapsed = convert(exp_src, exp_dst, compress_image, codec, coroutines)
+            os.remove(exp_src)
+            print "Converted {:.1f} GB to {:.1f} GB, saved {:.1f} GB ({:.0f}%) in {:.0f}s".format(
+                before / 2.0**30, after / 2.0**30, (before - after) / 2.0**30,
+                100.0 * (before - after) / max(before, 1), elapsed)
+        else:
+            shutil.move(exp_src, exp_dst)
         print "Exported to: {}".format(exp_dst)
+
+        # the new image becomes the latest, descended from the staged one
+        reg = registry.Registry()
+        sha256 = reg.register(exp_dst, parent=reg.data.get("staged"))
+        print "Registered: {}".format(sha256)
         template = os.path.join(PREPARE_PATH, PREP_IMAGE_NAME)
         if os.path.exists(template):
             os.remove(template)
@@ -52,23 +156,31 @@ def export():
 def main(args):
     if args.compress:
         args.export = True
-        compress()
 
     if args.export:
-        export()
+        export(args.compress, args.codec, args.coroutines)
         cleanup()
         return
 
-    qcow_images = [ x for x in os.listdir(DEPLOY_PATH) if x.endswith(".qcow2") ]
-    qcow_images.sort()
+    # latest registered image, else the newest by name
+    reg = registry.Registry()
+    parent, latest = reg.latest()
+    if latest is not None and os.path.exists(os.path.join(DEPLOY_PATH, latest["name"])):
+        img_src = os.path.join(DEPLOY_PATH, latest["name"])
+    else:
+        qcow_images = [ x for x in os.listdir(DEPLOY_PATH) if x.endswith(".qcow2") ]
+        qcow_images.sort()
+        img_src = os.path.join(DEPLOY_PATH, qcow_images[-1])
+        parent = reg.sha256(img_src, record=True)
+    with reg.transaction() as data:
+        data["staged"] = parent
 
-    # copy latest image from deploy to prepare
-    img_src = os.path.join(DEPLOY_PATH, qcow_images[-1])
+    # stage latest image from deploy to prepare
     img_dst = os.path.join(PREPARE_PATH, PREP_IMAGE_NAME)
-    print "[*] Copying qcow2 image"
+    print "[*] Staging qcow2 image ({})".format(args.stage)
     print "SRC:", img_src
     print "DST:", img_dst
-    shutil.copy(img_src, img_dst)
+    stage(img_src, img_dst, args.stage)
 
     # copy template from deploy to prepare
     tmp_src = os.path.join(DEPLOY_PATH, PREP_TEMPLATE_NAME)
@@ -79,13 +191,18 @@ def main(args):
     shutil.copy(tmp_src, tmp_dst)
 
     diskpath = os.path.join(PREPARE_PATH, PREP_IMAGE_NAME)
-    template = kvm_create.create_xml(tmp_dst, disk=diskpath)
-    kvm_create.create_vms(template, is_temporary=True)
+    domains = kvm_create.render_xml(tmp_dst, disk=diskpath)
+    kvm_create.create_vms(domains, is_temporary=True)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--compress", action="store_true")
     parser.add_argument("--export", action="store_true")
+    parser.add_argument("--codec", default="zlib", choices=["zlib", "zstd"],
+                        help="qcow2 compression, zstd needs qemu 5.1 on every kvm host")
+    parser.add_argument("--stage", default="overlay", choices=["overlay", "reflink", "copy"],
+                        help="how the latest image is staged for prep")
+    parser.add_argument("--coroutines", default=16, type=int, help="parallel qemu-img convert coroutines (max 16)")
     args = parser.parse_args()
 
     main(args)
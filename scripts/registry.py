@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# registry.py - index of golden image versions
+#   records each image's sha256, lineage, size and the kvm hosts holding it
+#   so callers can pick the latest image and skip hashing or copying it
+import argparse
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import time
+
+BASE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEPLOY_PATH = os.path.join(BASE_PATH, "roles", "do.deploy", "files")
+REGISTRY_PATH = os.path.join(DEPLOY_PATH, "registry.json")
+
+
+def checksum(path, blocksize=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(blocksize), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Registry(object):
+    """
+    json index of images keyed by sha256
+
+    {
+        "latest": "<sha256>", "staged": "<sha256 of the image being prepared>",
+        "names": { "<file name>": "<sha256>" },
+        "images": { "<sha256>": {
+            "name": "...", "size": 0, "mtime": 0.0, "created": 0.0,
+            "parent": "<sha256 prepared from>", "backing": "<sha256 of qcow2 backing>",
+            "hosts": { "<kvm host>": 0.0 } } }
+    }
+    """
+    def __init__(self, path=REGISTRY_PATH):
+        self.path = path
+        self.data = self._read()
+
+    def _read(self):
+        try:
+            with open(self.path, "rb") as fp:
+                data = json.load(fp)
+        except (IOError, ValueError):
+            data = {}
+        data.setdefault("latest", None)
+        data.setdefault("names", {})
+        data.setdefault("images", {})
+        return data
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        reloads the index under an exclusive lock and saves it afterwards,
+        so concurrent deploy forks do not lose each other's updates
+        """
+        with open(self.path + ".lock", "ab") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self.data = self._read()
+                yield self.data
+                tmp = self.path + ".tmp"
+                with open(tmp, "wb") as fp:
+                    json.dump(self.data, fp, indent=2, sort_keys=True)
+                os.rename(tmp, self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def get(self, sha256):
+        return self.data["images"].get(sha256)
+
+    def by_name(self, name):
+        # symlinks (e.g. base.qcow2 -> dated image) resolve to the image
+        sha256 = self.data["names"].get(os.path.basename(os.path.realpath(name)))
+        return (sha256, self.get(sha256)) if sha256 else (None, None)
+
+    def latest(self):
+        """ returns (sha256, entry) of the latest image, or (None, None) """
+        sha256 = self.data["latest"]
+        return (sha256, self.get(sha256)) if sha256 else (None, None)
+
+    def sha256(self, path, record=False):
+        """
+        recorded sha256 of an image file, hashing it only when it is not
+        registered or changed on disk since
+
+        record indexes a freshly hashed file so the next lookup is free
+        """
+        sha256, entry = self.by_name(path)
+        st = os.stat(path)
+        if entry is not None and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+            return sha256
+        sha256 = checksum(path)
+        if record:
+            self.register(path, latest=False, sha256=sha256)
+        return sha256
+
+    def register(self, path, parent=None, backing=None, latest=True, sha256=None):
+        """ adds or refreshes an image, returns its sha256 """
+        if sha256 is None:
+            sha256 = self.sha256(path)
+        st = os.stat(path)
+        name = os.path.basename(os.path.realpath(path))
+        with self.transaction() as data:
+            entry = data["images"].setdefault(sha256, { "created": time.time(), "hosts": {} })
+            entry.update({
+                "name": name,
+                "size": st.st_size,
+                "mtime": st.st_mtime,
+                "parent": parent if parent is not None else entry.get("parent"),
+                "backing": backing if backing is not None else entry.get("backing")
+            })
+            data["names"][name] = sha256
+            if latest:
+                data["latest"] = sha256
+        return sha256
+
+    def mark(self, sha256, host):
+        """ records that a kvm host holds the image """
+        with self.transaction() as data:
+            if sha256 in data["images"]:
+                data["images"][sha256]["hosts"][host] = time.time()
+
+    def present(self, sha256, host):
+        entry = self.get(sha256)
+        return entry is not None and host in entry["hosts"]
+
+    def lineage(self, sha256):
+        """ the image and its ancestors, newest first """
+        chain = []
+        while sha256 and sha256 in self.data["images"] and sha256 not in chain:
+            chain.append(sha256)
+            sha256 = self.data["images"][sha256]["parent"]
+        return chain
+
+
+def main(args):
+    reg = Registry(args.registry)
+    if args.cli == "latest":
+        sha256, entry = reg.latest()
+        if entry is None:
+            return 1
+        print os.path.join(os.path.dirname(args.registry), entry["name"])
+    elif args.cli == "sha256":
+        print reg.sha256(args.path, record=True)
+    elif args.cli == "register":
+        print reg.register(args.path, parent=args.parent, latest=not args.no_latest)
+    elif args.cli == "mark":
+        sha256 = args.image if reg.get(args.image) else reg.by_name(args.image)[0]
+        if sha256 is None:
+            sys.stderr.write("[-] unknown image {}\n".format(args.image))
+            return 1
+        for host in args.host:
+            reg.mark(sha256, host)
+    elif args.cli == "list":
+        for sha256, entry in sorted(reg.data["images"].iteritems(), key=lambda i: i[1]["created"]):
+            print "{}{} {} {:.1f} GB parent={} hosts={}".format(
+                "*" if sha256 == reg.data["latest"] else " ",
+                sha256[:12], entry["name"], entry["size"] / 2.0**30,
+                (entry["parent"] or "-")[:12], len(entry["hosts"]))
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--registry", default=REGISTRY_PATH)
+    subparsers = parser.add_subparsers(dest="cli")
+
+    subparsers.add_parser("latest", help="path of the latest image")
+    subparsers.add_parser("list", help="list registered images")
+
+    sha_subparser = subparsers.add_parser("sha256", help="sha256 of an image, from the index when current")
+    sha_subparser.add_argument("path")
+
+    register_subparser = subparsers.add_parser("register", help="add an image")
+    register_subparser.add_argument("path")
+    register_subparser.add_argument("-p", "--parent", help="sha256 of the image it was prepared from")
+    register_subparser.add_argument("--no-latest", action="store_true", help="do not make it the latest image")
+
+    mark_subparser = subparsers.add_parser("mark", help="record kvm hosts holding an image")
+    mark_subparser.add_argument("image", help="sha256 or file name")
+    mark_subparser.add_argument("host", nargs="+")
+
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,177 @@
+# results.py - structured per node results for fleet operations
+import json
+import math
+import sys
+
+import health
+
+
+def text(value):
+    """ guest output as unicode, windows consoles are rarely utf-8 """
+    if isinstance(value, str):
+        return value.decode("utf-8", "replace")
+    return value
+
+
+def node_record(task, label=None):
+    """
+    flattens a finished command_node_sequence task into one record
+
+    status is the first non-zero exit code of the sequence, or None if
+    the node could not be reached at all
+    """
+    node, commands = task.args[0], task.args[1]
+    record = {
+        "host": task.host,
+        "domain": node["name"],
+        "ip": node["ip"],
+        "command": label if label is not None else "; ".join(commands),
+        "status": None,
+        "duration": round(task.duration, 3),
+        "stdout": "",
+        "stderr": "",
+        "error": None
+    }
+    if task.error is not None:
+        record["error"] = repr(task.error)
+        return record
+
+    status = 0
+    for _, out, err, code in task.result:
+        record["stdout"] += text(out)
+        record["stderr"] += text(err)
+        if status == 0:
+            status = code
+    record["status"] = status
+    return record
+
+
+def lifecycle_record(task, label=None):
+    """
+    flattens a finished lifecycle_node task into one record
+
+    duration covers the action and any wait, i.e. the time to ready
+    """
+    dom, action = task.args[0], task.args[1]
+    return {
+        "host": task.host,
+        "domain": dom.name(),
+        "ip": task.result,
+        "command": label if label is not None else action,
+        "status": 0 if task.error is None else None,
+        "duration": round(task.duration, 3),
+        "stdout": "",
+        "stderr": "",
+        "error": repr(task.error) if task.error is not None else None
+    }
+
+
+def health_record(task, label=None):
+    """
+    flattens a finished health_node task into one record
+
+    status is 0 for a healthy guest and 1 otherwise
+    """
+    node = task.args[0]
+    record = {
+        "host": task.host,
+        "domain": node["name"],
+        "ip": node["ip"],
+        "command": label if label is not None else "health",
+        "status": None,
+        "duration": round(task.duration, 3),
+        "stdout": "",
+        "stderr": "",
+        "error": None
+    }
+    if task.error is not None:
+        record["error"] = repr(task.error)
+        return record
+    record["status"] = 0 if task.result["healthy"] else 1
+    record["stdout"] = text(health.describe(task.result))
+    record["checks"] = dict((name, dict(check, detail=text(check["detail"])))
+                            for name, check in task.result["checks"].iteritems())
+    return record
+
+
+def percentile(values, pct):
+    """ nearest rank percentile """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(rank - 1, 0)]
+
+
+class Summary(object):
+    def __init__(self, slowest=5):
+        self.slowest = slowest
+        self.records = []
+
+    def add(self, record):
+        self.records.append(record)
+
+    def report(self):
+        durations = [ r["duration"] for r in self.records ]
+        failures = [ r for r in self.records if r["status"] != 0 ]
+        slowest = sorted(self.records, key=lambda r: r["duration"], reverse=True)
+        return {
+            "total": len(self.records),
+            "successes": len(self.records) - len(failures),
+            "failures": len(failures),
+            "p50": percentile(durations, 50),
+            "p95": percentile(durations, 95),
+            "slowest": [ { "host": r["host"], "domain": r["domain"], "duration": r["duration"] }
+                         for r in slowest[:self.slowest] ]
+        }
+
+
+def print_text(record):
+    if record["error"] is not None:
+        print "[-] {} - {} - {}".format(record["host"], record["domain"], record["error"])
+        return
+    print "{} - {} - {} [exit {}, {:.1f}s]".format(
+        record["host"], record["domain"], record["command"], record["status"], record["duration"])
+    # encoded explicitly, stdout has no encoding when piped
+    if record["stderr"]:
+        print record["stderr"].encode("utf-8")
+    if record["stdout"]:
+        print record["stdout"].encode("utf-8")
+
+
+def print_summary(summary, stream=sys.stdout):
+    stream.write("=" * 50 + "\n")
+    stream.write("NODES:\t\t{total}\nSUCCEEDED:\t{successes}\nFAILED:\t\t{failures}\n".format(**summary))
+    if summary["total"]:
+        stream.write("P50:\t\t{:.1f}s\nP95:\t\t{:.1f}s\n".format(summary["p50"], summary["p95"]))
+        stream.write("SLOWEST:\n")
+        for r in summary["slowest"]:
+            stream.write("    {}\t{}\t{:.1f}s\n".format(r["host"], r["domain"], r["duration"]))
+
+
+def report(tasks, label=None, as_json=False, stream=sys.stdout, record=node_record):
+    """
+    emits a record per node as tasks complete, then the summary
+
+    json mode writes newline delimited records to stream and the
+    summary, also as json, to stderr so the records pipe cleanly;
+    record turns a finished task into its record
+
+    returns the summary
+    """
+    summary = Summary()
+    for task in tasks:
+        entry = record(task, label)
+        summary.add(entry)
+        if as_json:
+            stream.write(json.dumps(entry) + "\n")
+            stream.flush()
+        else:
+            print_text(entry)
+
+    result = summary.report()
+    if as_json:
+        sys.stderr.write(json.dumps({ "summary": result }) + "\n")
+    else:
+        print_summary(result, stream)
+    return result
@@ -0,0 +1,273 @@
+# sshpool.py - persistent, shared ssh sessions to kvm hosts
+#   one transport per host carries every command, sftp and tunnel channel
+import contextlib
+import select
+import socket
+import threading
+import time
+
+import paramiko
+
+SSH_ERRORS = (paramiko.SSHException, socket.error, EOFError)
+
+
+class SSHConnection(object):
+    """
+    single reusable ssh transport to a kvm host
+
+    commands and sftp sessions are multiplexed as channels over the
+    transport, limited to `channels` concurrent channels
+    """
+    def __init__(self, host, user, channels=8, keepalive=30, timeout=10):
+        self.hostname = host
+        self.username = user
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.client = None
+        self.forwards = {}
+        self.last_used = time.time()
+        self.active = 0
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(channels)
+
+    def _connect(self):
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(self.hostname, username=self.username, timeout=self.timeout)
+        client.get_transport().set_keepalive(self.keepalive)
+        return client
+
+    def transport(self):
+        """
+        returns a live transport, reconnecting if the previous one dropped
+        """
+        with self.lock:
+            transport = self.client.get_transport() if self.client else None
+            if transport is None or not transport.is_active():
+                self._close()
+                self.client = self._connect()
+                transport = self.client.get_transport()
+            return transport
+
+    @contextlib.contextmanager
+    def channel(self):
+        """
+        reserves a channel slot on the connection for the duration
+        """
+        with self.slots:
+            with self.lock:
+                self.active += 1
+            try:
+                yield
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    self.last_used = time.time()
+
+    def _open_channel(self, kind="session", dest_addr=None, src_addr=None):
+        # a failed channel open means nothing was sent yet, retry once on
+        # a new transport if the old one died
+        transport = self.transport()
+        try:
+            return transport.open_channel(kind, dest_addr, src_addr, timeout=self.timeout)
+        except SSH_ERRORS:
+            if transport.is_active():
+                # refused or timed out (e.g. a guest that is down or still
+                # booting), the transport and the channels sharing it are fine
+                raise
+            return self.transport().open_channel(kind, dest_addr, src_addr, timeout=self.timeout)
+
+    def exec_command(self, command):
+        """
+        runs a shell command on the host
+
+        returns a tuple of (stdout, stderr, exit status)
+        """
+        with self.channel():
+            chan = self._open_channel()
+            try:
+                chan.exec_command(command)
+                stdout = chan.makefile("rb")
+                stderr = chan.makefile_stderr("rb")
+                out = stdout.read()
+                err = stderr.read()
+                status = chan.recv_exit_status()
+            finally:
+                chan.close()
+        return (out, err, status)
+
+    @contextlib.contextmanager
+    def sftp(self):
+        """
+        opens an sftp session over the shared transport
+        """
+        with self.channel():
+            transport = self.transport()
+            try:
+                sftp = paramiko.SFTPClient.from_transport(transport)
+            except SSH_ERRORS:
+                if transport.is_active():
+                    raise
+                sftp = paramiko.SFTPClient.from_transport(self.transport())
+            try:
+                yield sftp
+            finally:
+                sftp.close()
+
+    def reachable(self, host, port):
+        """
+        whether host:port, as seen from the kvm host, accepts connections
+        """
+        with self.channel():
+            try:
+                chan = self.transport().open_channel(
+                    "direct-tcpip", (host, port), ("127.0.0.1", 0), timeout=self.timeout)
+            except paramiko.ChannelException:
+                # refused by the kvm host, the transport itself is fine
+                return False
+            chan.close()
+        return True
+
+    def forward(self, host, port):
+        """
+        tunnels host:port, as seen from the kvm host, to a local port
+
+        returns the local port; tunnels are reused for the same target
+        """
+        with self.lock:
+            listener = self.forwards.get((host, port))
+            if listener is None:
+                listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                listener.bind(("127.0.0.1", 0))
+                listener.listen(16)
+                self.forwards[(host, port)] = listener
+                t = threading.Thread(
+                    name="{}-{}:{}".format(self.hostname, host, port),
+                    target=self._accept,
+                    args=(listener, host, port)
+                )
+                t.daemon = True
+                t.start()
+            return listener.getsockname()[1]
+
+    def _accept(self, listener, host, port):
+        while True:
+            try:
+                sock, peer = listener.accept()
+            except socket.error:
+                # listener closed
+                return
+            try:
+                chan = self._open_channel("direct-tcpip", (host, port), peer)
+            except SSH_ERRORS:
+                sock.close()
+                continue
+            t = threading.Thread(target=self._pump, args=(sock, chan))
+            t.daemon = True
+            t.start()
+
+    def _pump(self, sock, chan):
+        # tunnelled connections hold the transport open while alive
+        with self.lock:
+            self.active += 1
+        try:
+            while True:
+                r, _, _ = select.select([sock, chan], [], [])
+                if sock in r:
+                    data = sock.recv(32768)
+                    if not data:
+                        break
+                    chan.sendall(data)
+                if chan in r:
+                    data = chan.recv(32768)
+                    if not data:
+                        break
+                    sock.sendall(data)
+        except SSH_ERRORS:
+            pass
+        finally:
+            chan.close()
+            sock.close()
+            with self.lock:
+                self.active -= 1
+                self.last_used = time.time()
+
+    @property
+    def idle(self):
+        with self.lock:
+            if self.active:
+                return 0
+            return time.time() - self.last_used
+
+    def _close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    def close(self, forwards=False):
+        """
+        closes the transport, and local tunnel listeners if forwards is set
+        """
+        with self.lock:
+            self._close()
+            if forwards:
+                for listener in self.forwards.values():
+                    listener.close()
+                self.forwards = {}
+
+
+class SSHPool(object):
+    """
+    keeps one SSHConnection per (user, host), closing idle transports
+    """
+    def __init__(self, channels=8, keepalive=30, idle_timeout=300, timeout=10):
+        self.channels = channels
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.reaper = None
+
+    def get(self, host, user):
+        key = (user, host)
+        with self.lock:
+            conn = self.connections.get(key)
+            if conn is None:
+                conn = SSHConnection(
+                    host, user,
+                    channels=self.channels,
+                    keepalive=self.keepalive,
+                    timeout=self.timeout
+                )
+                self.connections[key] = conn
+            if self.reaper is None:
+                self.reaper = threading.Thread(name="sshpool-reaper", target=self._reap)
+                self.reaper.daemon = True
+                self.reaper.start()
+        return conn
+
+    def evict_idle(self):
+        """
+        closes transports unused for longer than idle_timeout
+
+        evicted connections reconnect transparently on next use
+        """
+        with self.lock:
+            conns = self.connections.values()
+        for conn in conns:
+            if conn.client is not None and conn.idle > self.idle_timeout:
+                conn.close()
+
+    def _reap(self):
+        while True:
+            time.sleep(min(self.idle_timeout, 30))
+            self.evict_idle()
+
+    def close(self):
+        with self.lock:
+            conns = self.connections.values()
+            self.connections = {}
+        for conn in conns:
+            conn.close(forwards=True)
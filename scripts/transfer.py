@@ -0,0 +1,283 @@
+# transfer.py - chunked, resumable file uploads to kvm hosts
+#   files are checksummed per chunk so interrupted or corrupted uploads
+#   only resend the chunks that differ
+import contextlib
+import hashlib
+import json
+import os
+import pipes
+import sys
+import threading
+import time
+
+CHUNK_SIZE = 8 << 20
+STORE_SIZE = 20 << 30
+# a manifest lock older than this was left by a dead sender
+LOCK_TIMEOUT = 60
+
+# run on the kvm host to checksum a file per chunk (python 2 or 3)
+DIGEST_SCRIPT = """
+import hashlib, json, os, sys
+path, size = sys.argv[1], int(sys.argv[2])
+out = {"size": -1, "sha256": None, "chunks": []}
+if os.path.isfile(path):
+    full = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            b = f.read(size)
+            if not b:
+                break
+            full.update(b)
+            out["chunks"].append(hashlib.sha256(b).hexdigest())
+    out["size"] = os.path.getsize(path)
+    out["sha256"] = full.hexdigest()
+print(json.dumps(out))
+"""
+
+
+class LocalFile(object):
+    """
+    local file with its whole and per chunk sha256, computed once and
+    shared by every upload
+    """
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.size = os.path.getsize(path)
+        self.chunks = []
+        full = hashlib.sha256()
+        with open(path, "rb") as fp:
+            for block in iter(lambda: fp.read(chunk_size), b""):
+                full.update(block)
+                self.chunks.append(hashlib.sha256(block).hexdigest())
+        self.sha256 = full.hexdigest()
+
+
+class Progress(object):
+    """
+    aggregate throughput across concurrent uploads, printed periodically
+    """
+    def __init__(self, interval=2, stream=sys.stderr):
+        self.interval = interval
+        self.stream = stream
+        self.sent = 0
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def add(self, count):
+        with self.lock:
+            self.sent += count
+
+    def rate(self):
+        elapsed = max(time.time() - self.started, 0.001)
+        return self.sent / elapsed
+
+    def _report(self):
+        while not self.done.wait(self.interval):
+            self.stream.write("sent {:.1f} MB at {:.1f} MB/s\n".format(
+                self.sent / 1e6, self.rate() / 1e6))
+
+    def start(self):
+        t = threading.Thread(name="progress", target=self._report)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self.done.set()
+
+
+def remote_digest(ssh, path, chunk_size=CHUNK_SIZE):
+    """
+    returns {"size", "sha256", "chunks"} of a file on the kvm host,
+    size is -1 when the file does not exist
+    """
+    cmd = "python -c {} {} {}".format(
+        pipes.quote(DIGEST_SCRIPT), pipes.quote(path), chunk_size)
+    out, err, status = ssh.exec_command(cmd)
+    if status != 0:
+        raise IOError("digest of {} failed: {}".format(path, err.strip()))
+    return json.loads(out)
+
+
+def _send_chunks(sftp, local, part, indexes, progress=None):
+    mode = "r+" if indexes != range(len(local.chunks)) else "w"
+    try:
+        remote = sftp.open(part, mode)
+    except IOError:
+        remote = sftp.open(part, "w")
+        indexes = range(len(local.chunks))
+    with remote, open(local.path, "rb") as fp:
+        remote.set_pipelined(True)
+        for i in indexes:
+            fp.seek(i * local.chunk_size)
+            block = fp.read(local.chunk_size)
+            remote.seek(i * local.chunk_size)
+            remote.write(block)
+            if progress is not None:
+                progress.add(len(block))
+        remote.truncate(local.size)
+
+
+def upload(ssh, local, remote_path, progress=None, retries=2, check_existing=True):
+    """
+    uploads a LocalFile to remote_path over a pooled ssh connection
+
+    an identical remote file is left alone, otherwise chunks are written
+    to remote_path + ".part" (resuming whatever is already there) and
+    it is renamed into place once its checksum matches
+
+    returns True if anything was sent, False if the host already had it
+    """
+    if check_existing and remote_digest(ssh, remote_path, local.chunk_size)["sha256"] == local.sha256:
+        return False
+
+    part = remote_path + ".part"
+    for attempt in xrange(retries + 1):
+        current = remote_digest(ssh, part, local.chunk_size)
+        if current["sha256"] == local.sha256:
+            break
+        have = current["chunks"]
+        indexes = [ i for i, digest in enumerate(local.chunks)
+                    if i >= len(have) or have[i] != digest ]
+        try:
+            with ssh.sftp() as sftp:
+                _send_chunks(sftp, local, part, indexes, progress)
+        except IOError:
+            # left behind by root, clear it and start over
+            ssh.exec_command("sudo rm -f {} {}".format(pipes.quote(part), pipes.quote(remote_path)))
+            with ssh.sftp() as sftp:
+                _send_chunks(sftp, local, part, range(len(local.chunks)), progress)
+    else:
+        current = remote_digest(ssh, part, local.chunk_size)
+        if current["sha256"] != local.sha256:
+            raise IOError("checksum mismatch for {} after {} attempts".format(part, retries + 1))
+
+    with ssh.sftp() as sftp:
+        sftp.posix_rename(part, remote_path)
+    return True
+
+
+class Store(object):
+    """
+    content addressed staging area on a kvm host
+
+    files are stored as <path>/<sha256>, only renamed into place once
+    verified, and tracked in <path>/manifest.json:
+
+        { "<sha256>": { "name": "...", "size": 0, "used": 0.0 } }
+
+    least recently used files are evicted to keep the store under max_size;
+    manifest updates hold <path>/manifest.lock (a directory, created
+    atomically) so concurrent senders do not lose each other's entries
+    """
+    def __init__(self, ssh, path, max_size=STORE_SIZE):
+        self.ssh = ssh
+        self.path = path
+        self.max_size = max_size
+        self.manifest_path = os.path.join(path, "manifest.json")
+        self.lock_path = os.path.join(path, "manifest.lock")
+
+    def _remote_now(self, sftp):
+        # the kvm host's clock, lock ages must not depend on clock skew
+        probe = self.lock_path + ".now"
+        with sftp.open(probe, "w"):
+            pass
+        return sftp.stat(probe).st_mtime
+
+    @contextlib.contextmanager
+    def _locked(self, sftp, timeout=LOCK_TIMEOUT):
+        while True:
+            try:
+                sftp.mkdir(self.lock_path)
+                break
+            except IOError:
+                try:
+                    if self._remote_now(sftp) - sftp.stat(self.lock_path).st_mtime > timeout:
+                        sftp.rmdir(self.lock_path)
+                        continue
+                except IOError:
+                    # released in the meantime
+                    continue
+                time.sleep(0.2)
+        try:
+            yield
+        finally:
+            sftp.rmdir(self.lock_path)
+
+    def _read_manifest(self, sftp):
+        try:
+            with sftp.open(self.manifest_path, "r") as fp:
+                return json.loads(fp.read())
+        except (IOError, ValueError):
+            return {}
+
+    def _write_manifest(self, sftp, manifest):
+        tmp = self.manifest_path + ".tmp"
+        with sftp.open(tmp, "w") as fp:
+            fp.write(json.dumps(manifest, separators=(",", ":")))
+        sftp.posix_rename(tmp, self.manifest_path)
+
+    def _exists(self, sftp, digest):
+        try:
+            sftp.stat(os.path.join(self.path, digest))
+            return True
+        except IOError:
+            return False
+
+    def put(self, local, progress=None, keep=()):
+        """
+        stages a LocalFile under its sha256
+
+        keep lists digests that must survive eviction, e.g. the rest of
+        the batch being sent
+
+        returns True if anything was sent, False if it was already staged
+        """
+        with self.ssh.sftp() as sftp:
+            try:
+                sftp.mkdir(self.path)
+            except IOError:
+                # already exists
+                pass
+            staged = self._exists(sftp, local.sha256)
+
+        # files only appear under their digest once verified
+        sent = False
+        if not staged:
+            remote_path = os.path.join(self.path, local.sha256)
+            sent = upload(self.ssh, local, remote_path, progress, check_existing=False)
+
+        with self.ssh.sftp() as sftp:
+            with self._locked(sftp):
+                manifest = self._read_manifest(sftp)
+                manifest[local.sha256] = {
+                    "name": os.path.basename(local.path),
+                    "size": local.size,
+                    "used": time.time()
+                }
+                self._evict(sftp, manifest, keep=set(keep) | set([local.sha256]))
+                self._write_manifest(sftp, manifest)
+        return sent
+
+    def _evict(self, sftp, manifest, keep=()):
+        total = sum(entry["size"] for entry in manifest.itervalues())
+        lru = sorted(manifest.iteritems(), key=lambda item: item[1]["used"])
+        for digest, entry in lru:
+            if total <= self.max_size:
+                break
+            if digest in keep:
+                continue
+            try:
+                sftp.remove(os.path.join(self.path, digest))
+            except IOError:
+                # already gone
+                pass
+            del manifest[digest]
+            total -= entry["size"]
+
+    @staticmethod
+    def url_path(local):
+        """ path of a staged file under the kvm host web root """
+        return "cas/{}".format(local.sha256)
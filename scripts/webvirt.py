@@ -2,20 +2,113 @@
 # webvirt.py - flask server to allow nodes to interact directly
 #   with kvm host for snapshot management and information retrieval
 import argparse
+import contextlib
 import json
 import os
+import Queue
 import re
+import threading
+import time
+import xml.etree.ElementTree as ET
 
 import logging
 from logging.handlers import RotatingFileHandler
 
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify
 import libvirt
 
+try:
+    import waitress
+except ImportError:
+    waitress = None
+
+try:
+    import winrmpool
+except ImportError:
+    winrmpool = None
+
+import fanout
+import health
+import metrics
+
+# delays (seconds) between dhcp lease checks after a domain starts
+LEASE_RETRY = (2, 5, 10, 20, 40, 60)
+
+def run_event_loop():
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+# the default event loop must be registered before any connection opens
+libvirt.virEventRegisterDefaultImpl()
+event_thread = threading.Thread(name="libvirt-events", target=run_event_loop)
+event_thread.daemon = True
+event_thread.start()
+
+def normalize_mac(mac):
+    return re.sub(":|-", "", mac).lower()
+
+class ConnectionPool(object):
+    """ fixed set of libvirt connections, each used by one request at a time """
+    def __init__(self, uri, size=4):
+        self.connections = Queue.Queue()
+        for _ in xrange(size):
+            self.connections.put(libvirt.open(uri))
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.connections.get()
+        try:
+            yield conn
+        finally:
+            self.connections.put(conn)
+
+    def close(self):
+        while not self.connections.empty():
+            self.connections.get().close()
+
 class KVM(object):
-    def __init__(self):
-        self.conn = libvirt.open("qemu:///system")
-        self.inventory = self.get_inventory()
+    def __init__(self, uri="qemu:///system", network="default", pool_size=4,
+                 winrm_auth=None, winrm_port=5986, health_ttl=health.HEALTH_TTL,
+                 health_timeout=health.CHECK_TIMEOUT, health_workers=32):
+        # self.conn is reserved for event tracking and lookups, slow domain
+        # operations run on pooled connections under a per-domain lock
+        self.conn = libvirt.open(uri)
+        try:
+            self.conn.setKeepAlive(5, 3)
+        except libvirt.libvirtError:
+            # only the remote driver supports keepalive, local drivers
+            # (e.g. test:///default) cannot drop the connection anyway
+            pass
+        self.pool = ConnectionPool(uri, pool_size)
+        self.domain_locks = {}
+        self.network = network
+
+        # domain definitions, running state and dhcp leases are tracked
+        # separately and joined into the inventory on every change
+        self.lock = threading.RLock()
+        self.macs = {}
+        self.running = set()
+        self.leases = {}
+        self.last_miss = 0
+        self.inventory = []
+        self.by_mac = {}
+        self.by_ip = {}
+        self.by_name = {}
+
+        # registered before the initial scan so domains defined or started
+        # during it are not missed
+        self.conn.domainEventRegisterAny(
+            None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._on_lifecycle, None)
+        self.conn.domainEventRegisterAny(
+            None, libvirt.VIR_DOMAIN_EVENT_ID_REBOOT, self._on_reboot, None)
+        self.load()
+
+        # guest probes, winrm logins only with configured credentials
+        self.winrm_auth = winrm_auth if winrmpool is not None else None
+        self.winrm_port = winrm_port
+        self.health_cache = health.HealthCache(ttl=health_ttl)
+        self.health_timeout = health_timeout
+        self.health_workers = health_workers
 
         try:
             basepath = os.path.dirname(os.path.abspath(__file__))
@@ -27,23 +120,31 @@ class KVM(object):
             logging.error("Unable to retrieve kvm name:\n{}".format(e))
 
     def __del__(self):
+        self.pool.close()
         self.conn.close()
 
-    def node_reboot(self, domain):
-        domains = [ dom.name() for dom in self.domains ]
-        if domain not in domains:
+    @contextlib.contextmanager
+    def domain(self, name):
+        """ locks a domain and yields its handle on a pooled connection """
+        with self.lock:
+            lock = self.domain_locks.setdefault(name, threading.Lock())
+        with lock:
+            with self.pool.connection() as conn:
+                yield conn.lookupByName(name)
+
+    def node_reboot(self, name):
+        if name not in self.by_name:
             return
 
         try:
-            domain = self.conn.lookupByName(domain)
-            domain.reboot()
+            with self.domain(name) as domain:
+                domain.reboot()
             return True
         except libvirt.libvirtError, e:
-            logging.error("{} - Failed to reboot:\n{}".format(domain, e))
+            logging.error("{} - Failed to reboot:\n{}".format(name, e))
 
-    def node_snapshot_create(self, domain):
-        domains = [ dom.name() for dom in self.domains ]
-        if domain not in domains:
+    def node_snapshot_create(self, name):
+        if name not in self.by_name:
             return
 
         xml_head = """<domainsnapshot> <name>snapshot</name>
@@ -51,27 +152,26 @@ class KVM(object):
         <disks><disk name='hda' snapshot='internal'/></disks>"""
         xml_tail = "</domainsnapshot>"
         try:
-            domain = self.conn.lookupByName(domain)
-            self.node_snapshot_clear(domain)
-            xml_desc = xml_head + domain.XMLDesc() + xml_tail
-            domain.snapshotCreateXML(xml_desc)
+            with self.domain(name) as domain:
+                self.node_snapshot_clear(domain)
+                xml_desc = xml_head + domain.XMLDesc() + xml_tail
+                domain.snapshotCreateXML(xml_desc)
             return True
         except libvirt.libvirtError, e:
-            logging.error("{} - Failed to create snapshot:\n{}".format(domain, e))
+            logging.error("{} - Failed to create snapshot:\n{}".format(name, e))
 
-    def node_snapshot_revert(self, domain):
-        domains = [ dom.name() for dom in self.domains ]
-        if domain not in domains:
+    def node_snapshot_revert(self, name):
+        if name not in self.by_name:
             return
 
         try:
-            domain = self.conn.lookupByName(domain)
-            self.node_snapshot_clear(domain)
-            snap = domain.snapshotCurrent()
-            if domain.revertToSnapshot(snap) == 0:
-                return True
+            with self.domain(name) as domain:
+                self.node_snapshot_clear(domain)
+                snap = domain.snapshotCurrent()
+                if domain.revertToSnapshot(snap) == 0:
+                    return True
         except libvirt.libvirtError, e:
-            logging.error("{} - Failed to revert snapshot:\n{}".format(domain, e))
+            logging.error("{} - Failed to revert snapshot:\n{}".format(name, e))
 
     def node_snapshot_clear(self, domain):
         try:
@@ -80,15 +180,22 @@ class KVM(object):
             logging.error("Failed to clear snapshot: {}".format(e))
 
     def find_domain(self, **kwargs):
-        inv = self.inventory
+        inv = self._find_domain(**kwargs)
+        if inv == [] and time.time() - self.last_miss > 1:
+            # a lease may have been handed out since the last event
+            self.last_miss = time.time()
+            self.refresh_leases()
+            inv = self._find_domain(**kwargs)
+        return inv
+
+    def _find_domain(self, **kwargs):
         if kwargs.has_key("mac"):
-            mac = re.sub(":|-", "", kwargs["mac"]).lower()
-            inv = [ i for i in inv if i["mac"] == mac ]
+            info = self.by_mac.get(normalize_mac(kwargs["mac"]))
         elif kwargs.has_key("ip"):
-            inv = [ i for i in inv if i["ip"] == kwargs["ip"] ]
+            info = self.by_ip.get(kwargs["ip"])
         else:
-            inv = None
-        return inv
+            return None
+        return [ info ] if info else []
 
     @property
     def domains(self):
@@ -96,28 +203,149 @@ class KVM(object):
 
     def get_inventory(self):
         inventory = []
-        for domain in self.domains:
-            net_info = domain.interfaceAddresses(0)
-            for _, info in net_info.iteritems():
-                mac = info["hwaddr"]
-                ip = info["addrs"][0]["addr"]
-                name = domain.name()
-
-                info = {
-                    "name": name,
-                    "ip": ip,
-                    "mac": re.sub(":|-", "", mac)
-                }
-                inventory.append(info)
+        with self.lock:
+            for mac, ip in self.leases.iteritems():
+                name = self.macs.get(mac)
+                if name in self.running:
+                    info = {
+                        "name": name,
+                        "ip": ip,
+                        "mac": mac
+                    }
+                    inventory.append(info)
         return inventory
 
+    def reindex(self):
+        """ rebuilds the inventory and its mac / ip lookup indexes """
+        with self.lock:
+            inventory = self.get_inventory()
+            self.by_mac = dict((info["mac"], info) for info in inventory)
+            self.by_ip = dict((info["ip"], info) for info in inventory)
+            self.inventory = inventory
+
+    def load(self):
+        """ builds the initial inventory, later kept current by events """
+        for domain in self.domains:
+            try:
+                self.define_domain(domain)
+                active = domain.isActive()
+            except libvirt.libvirtError:
+                # undefined since it was listed, its event handles it
+                continue
+            if active:
+                with self.lock:
+                    self.running.add(domain.name())
+        self.refresh_leases()
+
+    def define_domain(self, domain):
+        """ records the mac addresses of a (re)defined domain """
+        name = domain.name()
+        xml = ET.fromstring(domain.XMLDesc())
+        macs = [ normalize_mac(mac.attrib["address"])
+                 for mac in xml.findall("./devices/interface/mac") ]
+        with self.lock:
+            self.macs = dict((m, n) for m, n in self.macs.iteritems() if n != name)
+            self.macs.update((mac, name) for mac in macs)
+            self.by_name[name] = domain
+            self.reindex()
+
+    def undefine_domain(self, name):
+        with self.lock:
+            self.macs = dict((m, n) for m, n in self.macs.iteritems() if n != name)
+            self.by_name.pop(name, None)
+            self.running.discard(name)
+            self.reindex()
+
+    def refresh_leases(self):
+        """ replaces lease info with a single DHCPLeases call """
+        try:
+            net = self.conn.networkLookupByName(self.network)
+            leases = dict((normalize_mac(lease["mac"]), lease["ipaddr"])
+                          for lease in net.DHCPLeases())
+        except libvirt.libvirtError, e:
+            logging.error("Failed to retrieve dhcp leases:\n{}".format(e))
+            return
+        with self.lock:
+            self.leases = leases
+            self.reindex()
+
+    def watch_lease(self, name, attempt=0):
+        """ refreshes leases until the started domain shows up """
+        self.refresh_leases()
+        with self.lock:
+            found = any(self.macs.get(mac) == name for mac in self.by_mac)
+            running = name in self.running
+        if not found and running and attempt < len(LEASE_RETRY):
+            self._defer(LEASE_RETRY[attempt], self.watch_lease, name, attempt + 1)
+
+    def _defer(self, delay, fn, *args):
+        # keep libvirt calls out of the event loop thread
+        t = threading.Timer(delay, fn, args)
+        t.daemon = True
+        t.start()
+
+    def _on_lifecycle(self, conn, domain, event, detail, opaque):
+        name = domain.name()
+        if event == libvirt.VIR_DOMAIN_EVENT_DEFINED:
+            self._defer(0, self.define_domain, domain)
+        elif event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+            self.undefine_domain(name)
+        elif event == libvirt.VIR_DOMAIN_EVENT_STARTED:
+            with self.lock:
+                self.running.add(name)
+            self._defer(0, self.watch_lease, name)
+        elif event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
+            with self.lock:
+                self.running.discard(name)
+                self.reindex()
+
+    def _on_reboot(self, conn, domain, opaque):
+        self._defer(LEASE_RETRY[0], self.watch_lease, domain.name())
+
+    def _run_ps(self, ip, command):
+        session = winrmpool.session(ip, self.winrm_port, self.winrm_auth,
+                                    https=self.winrm_port != winrmpool.WINRM_HTTP_PORT)
+        res = session.run_ps(command)
+        return (res.std_out, res.std_err, res.status_code)
+
+    def health_checks(self, name):
+        """ checks for a guest, in the order they are probed """
+        with self.lock:
+            domain = self.by_name.get(name)
+            info = dict((i["name"], i) for i in self.inventory).get(name)
+        ip = info["ip"] if info else None
+
+        checks = [
+            ("domain", lambda: health.domain_check(domain.state()[0])),
+            ("lease", lambda: health.lease_check(ip)),
+            ("port", lambda: health.port_check(
+                lambda p: health.tcp_connect(ip, p, self.health_timeout), self.winrm_port))
+        ]
+        if self.winrm_auth is not None:
+            checks.append(("winrm", lambda: health.winrm_check(lambda c: self._run_ps(ip, c))))
+        return checks
+
+    def health(self, name=None):
+        """ probes one or all guests concurrently, cached for a short while """
+        with self.lock:
+            names = sorted(self.by_name) if name is None else [ name ]
+        names = [ n for n in names if n in self.by_name ]
+
+        # probe the addresses guests hold now, not the last indexed ones
+        self.refresh_leases()
+        fan = fanout.FanOut(workers=self.health_workers, per_host=self.health_workers)
+        for n in names:
+            fan.submit(self.name, self.health_cache.probe, n, self.health_checks(n), self.health_timeout)
+        return dict((task.args[0], task.result) for task in fan.run())
+
     @property
     def version(self):
         return { "name": self.name }
 
 
 webvirt = Flask(__name__)
-kvm = KVM()
+kvm = None
+collector = None
 
 @webvirt.route("/")
 def index():
@@ -157,18 +385,69 @@ def node_snapshot_revert(name):
 @webvirt.route("/node/<name>/reboot")
 def node_reboot(name):
     """ reboot nodes """
-    return jsonify(kvm.reboot(name))
+    return jsonify(kvm.node_reboot(name))
+
+@webvirt.route("/health")
+def health_all():
+    """ readiness of all nodes """
+    return jsonify(kvm.health())
+
+@webvirt.route("/health/<name>")
+def health_node(name):
+    """ readiness of a node """
+    return jsonify(kvm.health(name).get(name))
+
+@webvirt.route("/metrics")
+def metrics_all():
+    """ latest domain and host metrics for prometheus """
+    return Response(collector.prometheus(kvm.name), mimetype="text/plain; version=0.0.4")
+
+@webvirt.route("/metrics/summary")
+def metrics_summary():
+    """ host allocation and observed use over the sample window """
+    return jsonify(collector.summary())
+
+def serve(host, port, threads=16):
+    """ serves requests concurrently, with waitress when it is installed """
+    if waitress is not None:
+        waitress.serve(webvirt, host=host, port=port, threads=threads)
+    else:
+        webvirt.run(host=host, port=port, threaded=True)
 
 def main(args):
+    global kvm, collector
     handler = RotatingFileHandler("webvirt.log", maxBytes=1000000)
     handler.setLevel(logging.INFO)
     webvirt.logger.addHandler(handler)
-    webvirt.run(host=args.ip, port=args.port)
+    winrm_auth = None
+    if args.guest_user and args.guest_pass:
+        winrm_auth = (args.guest_user, args.guest_pass)
+    kvm = KVM(
+        uri=args.uri,
+        network=args.network,
+        pool_size=args.pool_size,
+        winrm_auth=winrm_auth,
+        winrm_port=args.winrm_port,
+        health_ttl=args.health_ttl
+    )
+    collector = metrics.Collector(kvm.pool, args.metrics_interval, args.metrics_samples).start()
+    serve(args.ip, args.port, threads=args.threads)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-p", "--port", default=8080, type=int)
     parser.add_argument("-i", "--ip", default="192.168.122.1")
+    parser.add_argument("-c", "--uri", default="qemu:///system")
+    parser.add_argument("--network", default="default")
+    parser.add_argument("--pool-size", default=4, type=int, help="libvirt connections for domain operations")
+    parser.add_argument("--threads", default=16, type=int, help="request worker threads")
+    parser.add_argument("-gu", "--guest-user", help="node user for winrm health checks")
+    parser.add_argument("-gp", "--guest-pass", help="node password for winrm health checks")
+    parser.add_argument("--winrm-port", default=5986, type=int,
+                        help="node winrm port, https unless 5985")
+    parser.add_argument("--health-ttl", default=health.HEALTH_TTL, type=int, help="seconds to reuse health results")
+    parser.add_argument("--metrics-interval", default=metrics.SAMPLE_INTERVAL, type=int, help="seconds between stats samples")
+    parser.add_argument("--metrics-samples", default=metrics.SAMPLE_COUNT, type=int, help="samples kept in memory")
     args = parser.parse_args()
 
     main(args)
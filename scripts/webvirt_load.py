@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# webvirt_load.py - drives webvirt with concurrent requests against the
+#   libvirt test driver and reports per endpoint latency
+import argparse
+import random
+import socket
+import threading
+import time
+import urllib2
+
+import libvirt
+import webvirt
+
+DOMAIN_XML = """<domain type='test'>
+<name>{}</name> <memory>65536</memory> <vcpu>1</vcpu>
+<os><type>hvm</type></os>
+<devices><interface type='network'><mac address='{}'/><source network='default'/></interface></devices>
+</domain>"""
+
+# the test driver's default network is 192.168.122.0/24
+MAX_DOMAINS = 253
+
+def define_domains(conn, count, network="default"):
+    """
+    defines and starts count test domains, returns (name, mac) pairs
+
+    each gets a static dhcp host entry, which the test driver reports as
+    a lease, so /info/mac lookups hit rather than miss
+    """
+    net = conn.networkLookupByName(network)
+    domains = []
+    for i in xrange(count):
+        name = "load-{}".format(i+1)
+        mac = "52:54:00:00:{:02x}:{:02x}".format(i // 256, i % 256)
+        net.update(
+            libvirt.VIR_NETWORK_UPDATE_COMMAND_ADD_LAST,
+            libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST, -1,
+            "<host mac='{}' name='{}' ip='192.168.122.{}'/>".format(mac, name, i+2),
+            libvirt.VIR_NETWORK_UPDATE_AFFECT_LIVE | libvirt.VIR_NETWORK_UPDATE_AFFECT_CONFIG)
+        dom = conn.defineXML(DOMAIN_XML.format(name, mac))
+        dom.create()
+        domains.append((name, mac))
+    return domains
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+def worker(base_url, domains, deadline, snapshot_ratio, results):
+    while time.time() < deadline:
+        name, mac = random.choice(domains)
+        if random.random() < snapshot_ratio:
+            kind, path = "snapshot", "/node/{}/snapshot/create".format(name)
+        else:
+            kind, path = "info", "/info/mac/{}".format(mac)
+        started = time.time()
+        try:
+            body = urllib2.urlopen(base_url + path, timeout=60).read()
+            # an unknown mac answers null, which is a failed lookup
+            ok = body.strip() != "null"
+        except (urllib2.URLError, socket.error):
+            ok = False
+        results.append((kind, time.time() - started, ok))
+
+def main(args):
+    conn = libvirt.open(args.uri)
+    domains = define_domains(conn, args.domains)
+
+    webvirt.kvm = webvirt.KVM(uri=args.uri, pool_size=args.pool_size)
+    if args.snapshot_delay:
+        # simulate memory state snapshots taking a while
+        clear = webvirt.kvm.node_snapshot_clear
+        def slow_clear(domain):
+            time.sleep(args.snapshot_delay)
+            clear(domain)
+        webvirt.kvm.node_snapshot_clear = slow_clear
+
+    port = free_port()
+    t = threading.Thread(target=webvirt.serve, args=("127.0.0.1", port, args.threads))
+    t.daemon = True
+    t.start()
+
+    base_url = "http://127.0.0.1:{}".format(port)
+    for _ in xrange(50):
+        try:
+            urllib2.urlopen(base_url + "/", timeout=1).read()
+            break
+        except (urllib2.URLError, socket.error):
+            time.sleep(0.1)
+
+    results = []
+    deadline = time.time() + args.duration
+    clients = []
+    for _ in xrange(args.clients):
+        c = threading.Thread(
+            target=worker,
+            args=(base_url, domains, deadline, args.snapshot_ratio, results)
+        )
+        c.start()
+        clients.append(c)
+    [c.join() for c in clients]
+
+    print "server:\t{}".format("waitress" if webvirt.waitress else "flask (threaded)")
+    print "{:<10}{:>8}{:>8}{:>10}{:>10}{:>10}{:>10}".format(
+        "endpoint", "count", "errors", "req/s", "p50 ms", "p95 ms", "max ms")
+    for kind in ("info", "snapshot"):
+        times = [ r[1] for r in results if r[0] == kind ]
+        errors = len([ r for r in results if r[0] == kind and not r[2] ])
+        print "{:<10}{:>8}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+            kind, len(times), errors, len(times) / float(args.duration),
+            percentile(times, 50) * 1000, percentile(times, 95) * 1000,
+            max(times or [0]) * 1000)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--uri", default="test:///default")
+    parser.add_argument("-n", "--domains", default=20, type=int)
+    parser.add_argument("-C", "--clients", default=32, type=int, help="concurrent clients")
+    parser.add_argument("-d", "--duration", default=10, type=int, help="seconds")
+    parser.add_argument("--snapshot-ratio", default=0.05, type=float, help="share of requests creating snapshots")
+    parser.add_argument("--snapshot-delay", default=2.0, type=float, help="simulated snapshot seconds")
+    parser.add_argument("--pool-size", default=4, type=int)
+    parser.add_argument("--threads", default=16, type=int)
+    args = parser.parse_args()
+    if args.domains > MAX_DOMAINS:
+        parser.error("at most {} domains fit the test network".format(MAX_DOMAINS))
+
+    main(args)
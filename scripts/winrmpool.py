@@ -0,0 +1,73 @@
+# winrmpool.py - long-lived winrm sessions to kvm domains
+#   nodes sit on the kvm host nat network, so each session is reached
+#   through an ssh tunnel on the pooled kvm host connection
+import threading
+
+import requests
+import winrm
+import winrm.exceptions
+
+# guests listen on https (5986) with self-signed certificates, as the
+# do.prepare group vars expect; the plaintext listener is opt-in
+WINRM_PORT = 5986
+WINRM_HTTP_PORT = 5985
+# raised while a node is unreachable or still booting
+WINRM_ERRORS = (
+    requests.exceptions.RequestException,
+    winrm.exceptions.WinRMError,
+    winrm.exceptions.WinRMTransportError
+)
+
+
+def session(host, port, auth, https=True):
+    """ winrm.Session for host:port, https unless asked otherwise """
+    if not https:
+        return winrm.Session("http://{}:{}/wsman".format(host, port), auth=auth)
+    return winrm.Session("https://{}:{}/wsman".format(host, port), auth=auth,
+                         server_cert_validation="ignore")
+
+
+class WinRMPool(object):
+    """
+    caches one winrm.Session per (kvm host, node ip, credentials)
+    """
+    def __init__(self, port=WINRM_PORT):
+        self.port = port
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def session(self, ssh, ip, username, password):
+        """
+        returns a (session, lock) pair for the node, creating it on first use
+        """
+        key = (ssh.hostname, ip, username, password)
+        with self.lock:
+            entry = self.sessions.get(key)
+            if entry is None:
+                local_port = ssh.forward(ip, self.port)
+                entry = (session("127.0.0.1", local_port, (username, password),
+                                 https=self.port != WINRM_HTTP_PORT), threading.Lock())
+                self.sessions[key] = entry
+        return entry
+
+    def drop(self, ssh, ip, username, password):
+        with self.lock:
+            self.sessions.pop((ssh.hostname, ip, username, password), None)
+
+    def run_ps(self, ssh, ip, username, password, command):
+        """
+        runs powershell on a node
+
+        returns a tuple of (stdout, stderr, exit status)
+        """
+        session, lock = self.session(ssh, ip, username, password)
+        try:
+            with lock:
+                res = session.run_ps(command)
+        except requests.exceptions.ConnectionError:
+            # kept-alive connection went stale (tunnel or node restarted)
+            self.drop(ssh, ip, username, password)
+            session, lock = self.session(ssh, ip, username, password)
+            with lock:
+                res = session.run_ps(command)
+        return (res.std_out, res.std_err, res.status_code)